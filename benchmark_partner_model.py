@@ -0,0 +1,111 @@
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from partner_model import PartnerModel
+
+# boundaries of the environment's features, used to draw synthetic observations
+LOW = np.array([80, 1, 20, 0, 0, 0, 0, 0], dtype=float)
+HIGH = np.array([380, 220, 140, 1000, 1, 2, 1, 2], dtype=float)
+DISCRETE_FEATURES = [4, 5, 6, 7]
+
+
+def random_observations(rng, n):
+    obs = LOW + rng.random_sample((n, len(LOW))) * (HIGH - LOW)
+    obs[:, DISCRETE_FEATURES] = np.round(obs[:, DISCRETE_FEATURES])
+    return obs
+
+
+def operator_action(obs):
+    """
+    Synthetic operator whose action only depends on the state.
+    """
+    if obs[4] == 1:
+        return 1    # safety rods up
+    if obs[6] == 0:
+        return 7    # fuel rods down
+    if obs[2] < 60:
+        return 11   # add water
+    if obs[0] > 300:
+        return 10   # regulatory rods down
+    return 0
+
+
+def fill_partner_model(partner_model, rng, n):
+    """
+    Logs n synthetic (observation, action) pairs, as the GUI does at every step.
+    """
+    for obs, action in zip(random_observations(rng, n), rng.randint(0, 12, size=n)):
+        partner_model.add_observation(obs)
+        partner_model.set_action_to_last_obs(int(action))
+
+
+def fill_with_operator(partner_model, rng, n):
+    # each confirmed action refers to the observation preceding the new one
+    prev = np.array([80, 30, 120, 0, 1, 0, 1., 0])
+    for obs in random_observations(rng, n):
+        partner_model.add_observation(obs)
+        partner_model.set_action_to_last_obs(operator_action(prev))
+        prev = obs
+
+
+def check_stability(size, restarts, queries, seed):
+    """
+    Batch predictions on the same history, with k-means restarted from different seeds.
+    :return: fraction of queries predicted equally by all the restarts, fraction of correct predictions
+    """
+    queries = random_observations(np.random.RandomState(seed + 1), queries)
+    predictions = []
+    for restart in range(restarts):
+        with contextlib.redirect_stdout(io.StringIO()):
+            partner_model = PartnerModel("stability", restart, incremental=False, random_state=restart)
+            fill_with_operator(partner_model, np.random.RandomState(seed), size)
+            predictions.append([partner_model.get_prediction(obs) for obs in queries])
+    predictions = np.array(predictions)
+    truth = np.array([operator_action(obs) for obs in queries])
+    return (predictions == predictions[0]).all(axis=0).mean(), (predictions == truth).mean()
+
+
+def time_predictions(partner_model, rng, repetitions):
+    queries = random_observations(rng, repetitions)
+    start = time.perf_counter()
+    for obs in queries:
+        partner_model.get_prediction(obs)
+    return (time.perf_counter() - start) / repetitions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Partner model prediction latency per number of logged observations.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repetitions", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--check-stability", action="store_true",
+                        help="check that batch predictions agree across k-means restarts (exits 1 otherwise)")
+    parser.add_argument("--min-agreement", type=float, default=0.75)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        os.mkdir("log")
+
+        if args.check_stability:
+            agreement, accuracy = check_stability(2000, 5, 100, args.seed)
+            print("agreement across restarts: %.3f, accuracy: %.3f" % (agreement, accuracy))
+            sys.exit(0 if agreement >= args.min_agreement and accuracy >= args.min_agreement else 1)
+
+        print("observations,mode,prediction_ms")
+        for size in args.sizes:
+            for incremental in (True, False):
+                rng = np.random.RandomState(args.seed)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    partner_model = PartnerModel("benchmark", size, incremental=incremental)
+                    fill_partner_model(partner_model, rng, size)
+                    latency = time_predictions(partner_model, rng, args.repetitions)
+                mode = "incremental" if incremental else "batch"
+                print("%d,%s,%.3f" % (size, mode, latency * 1000))
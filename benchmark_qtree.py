@@ -0,0 +1,261 @@
+import argparse
+import contextlib
+import io
+import os
+import pickle
+import sys
+import tempfile
+import time
+
+import numpy as np
+from gym import spaces
+
+from model import QTree, Discrete, Action, convert_to_pybox, convert_to_pystate
+from NuclearPowerPlant import NuclearPowerPlant
+
+# the pure Python implementation imports its modules from its own directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "cqi_cpp", "src", "wrapper"))
+import qtree as py_qtree
+
+# same bounds as model.convert_to_pybox
+LOW = np.array([40, 1, 20, 0, 0, -1, 0, -1], dtype=np.float64)
+HIGH = np.array([380, 220, 140, 1000, 1, 1, 1, 1], dtype=np.float64)
+
+CSV_HEADER = "implementation,op,calls,seconds,us_per_call"
+
+
+def transition_stream(seed, num_steps, max_episode_steps):
+    """
+    Runs NuclearPowerPlant with random actions drawn from seed; an episode ends at the first anomaly or after
+    max_episode_steps steps.
+    :return: (s, a, r, s2, done) arrays, as for PyQTree.take_tuple_batch
+    """
+    rng = np.random.RandomState(seed)
+    env = NuclearPowerPlant()
+    s, a, r, s2, done = [], [], [], [], []
+    state = env.reset()
+    episode_steps = 0
+    for action in rng.randint(env.action_space.n, size=num_steps):
+        next_state, reward, anomaly, _ = env.step(int(action))
+        episode_steps += 1
+        s.append(state)
+        a.append(action)
+        r.append(reward)
+        s2.append(next_state)
+        done.append(anomaly)
+        if anomaly or episode_steps == max_episode_steps:
+            state = env.reset()
+            episode_steps = 0
+        else:
+            state = next_state
+    return (np.array(s, dtype=np.float64), np.array(a, dtype=np.int32), np.array(r, dtype=np.float64),
+            np.array(s2, dtype=np.float64), np.array(done, dtype=np.uint8))
+
+
+def make_trees(params):
+    env = NuclearPowerPlant()
+    cpp_tree = QTree(convert_to_pybox(env.observation_space), Discrete(env.action_space.n), None, **params)
+    py_tree = py_qtree.QTree(spaces.Box(LOW.copy(), HIGH.copy(), dtype=np.float64),
+                             spaces.Discrete(env.action_space.n), None, **params)
+    return cpp_tree, py_tree
+
+
+def read_cpp_tree(filename):
+    """
+    Parses a tree written by PyQTree.save_to_file.
+    :return: dict with the bounds, the split threshold and the nodes in pre-order, as tuples
+             ("internal", visits, feature, value) or ("leaf", visits, qs, features, values, left visits, right visits,
+             left qs, right qs)
+    """
+    tree = {"nodes": []}
+    with open(filename) as f:
+        lines = f.read().splitlines()
+    for line in lines:
+        tokens = line.split()
+        if tokens[0] == "params":
+            tree["split_thresh"] = float(tokens[tokens.index("splitThresh") + 1])
+        elif tokens[0] == "bounds":
+            high = tokens.index("high")
+            tree["low"] = np.array(tokens[2:high], dtype=np.float64)
+            tree["high"] = np.array(tokens[high + 1:], dtype=np.float64)
+        elif tokens[0] == "internal":
+            tree["nodes"].append(("internal", float(tokens[2]), int(tokens[4]), float(tokens[6])))
+        elif tokens[0] == "leaf":
+            splits = tokens.index("splits")
+            tree["nodes"].append(["leaf", float(tokens[2]), np.array(tokens[4:splits], dtype=np.float64),
+                                  [], [], [], [], [], []])
+        elif tokens[0] == "split":
+            right = tokens.index("rightQs")
+            left_qs = np.array(tokens[10:right], dtype=np.float64)
+            right_qs = left_qs if tokens[right + 1] == "shared" else np.array(tokens[right + 1:], dtype=np.float64)
+            for column, value in enumerate((int(tokens[2]), float(tokens[4]), float(tokens[6]), float(tokens[8]),
+                                            left_qs, right_qs), 3):
+                tree["nodes"][-1][column].append(value)
+    tree["nodes"] = [tuple(node) if node[0] == "internal" else
+                     tuple(node[:3]) + tuple(np.array(column) for column in node[3:]) for node in tree["nodes"]]
+    return tree
+
+
+def read_py_tree(qfunc):
+    """
+    :return: the same dict as read_cpp_tree, for a py_qtree.QTree
+    """
+    nodes = []
+    stack = [qfunc.root]
+    while stack:
+        node = stack.pop()
+        if node.is_leaf():
+            splits = node.splits
+            nodes.append(("leaf", node.visits, node.qs, splits.features, splits.values, splits.left_visits,
+                          splits.right_visits, splits.left_qs, splits.right_qs))
+        else:
+            nodes.append(("internal", node.visits, node.feature, node.value))
+            stack.extend((node.right_child, node.left_child))
+    return {"nodes": nodes, "split_thresh": qfunc.split_thresh, "low": qfunc.state_space.low,
+            "high": qfunc.state_space.high}
+
+
+def compare_trees(cpp_tree, py_tree, tolerance):
+    """
+    :return: list of differences between the trees read by read_cpp_tree and read_py_tree, empty if they have the same
+             structure and their values agree within tolerance (relative)
+    """
+    def close(x, y):
+        x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        return x.shape == y.shape and np.allclose(x, y, rtol=tolerance, atol=tolerance)
+
+    differences = []
+    for key in ("split_thresh", "low", "high"):
+        if not close(cpp_tree[key], py_tree[key]):
+            differences.append("%s: %s != %s" % (key, cpp_tree[key], py_tree[key]))
+    if len(cpp_tree["nodes"]) != len(py_tree["nodes"]):
+        differences.append("%d nodes != %d nodes" % (len(cpp_tree["nodes"]), len(py_tree["nodes"])))
+    for i, (cpp_node, py_node) in enumerate(zip(cpp_tree["nodes"], py_tree["nodes"])):
+        if cpp_node[0] != py_node[0]:
+            differences.append("node %d: %s != %s" % (i, cpp_node[0], py_node[0]))
+            break
+        if cpp_node[0] == "internal":
+            same = cpp_node[2] == py_node[2] and close(cpp_node[1::2], py_node[1::2])
+        else:
+            same = np.array_equal(cpp_node[3], py_node[3]) and all(close(x, y) for x, y in zip(cpp_node, py_node)
+                                                                   if not isinstance(x, str))
+        if not same:
+            differences.append("node %d (%s) differs" % (i, cpp_node[0]))
+    return differences
+
+
+def time_calls(function, args_list):
+    """
+    :return: seconds taken by each call
+    """
+    seconds = np.zeros(len(args_list))
+    for i, args in enumerate(args_list):
+        start = time.perf_counter()
+        function(*args)
+        seconds[i] = time.perf_counter() - start
+    return seconds
+
+
+def time_take_tuple(qfunc, transitions, cpp):
+    """
+    Feeds the transitions one at a time.
+    :return: seconds taken by each call, bool array of the calls which split the tree
+    """
+    s, a, r, s2, done = transitions
+    seconds = np.zeros(len(a))
+    splits = np.zeros(len(a), dtype=bool)
+    for i in range(len(a)):
+        start = time.perf_counter()
+        if cpp:
+            qfunc.take_tuple(convert_to_pystate(s[i]), Action(int(a[i])), r[i], convert_to_pystate(s2[i]),
+                             bool(done[i]))
+        else:
+            qfunc.take_tuple(s[i], a[i], r[i], s2[i], bool(done[i]))
+        seconds[i] = time.perf_counter() - start
+        splits[i] = qfunc.just_split()
+    return seconds, splits
+
+
+def run(transitions, params, repetitions, tolerance):
+    """
+    Drives both implementations with the same transitions and times their operations.
+    :return: list of (implementation, op, calls, seconds) rows, list of differences between the final trees
+    """
+    cpp_tree, py_tree = make_trees(params)
+    rows = []
+
+    cpp_seconds, cpp_splits = time_take_tuple(cpp_tree, transitions, cpp=True)
+    with contextlib.redirect_stdout(io.StringIO()):
+        py_seconds, py_splits = time_take_tuple(py_tree, transitions, cpp=False)
+    differences = []
+    if not np.array_equal(cpp_splits, py_splits):
+        differences.append("splits at steps %s != %s" % (np.flatnonzero(cpp_splits), np.flatnonzero(py_splits)))
+    for implementation, seconds, splits in (("cpp", cpp_seconds, cpp_splits), ("python", py_seconds, py_splits)):
+        rows.append((implementation, "take_tuple", int((~splits).sum()), seconds[~splits].sum()))
+        rows.append((implementation, "split", int(splits.sum()), seconds[splits].sum()))
+
+    batch_tree, _ = make_trees(params)
+    start = time.perf_counter()
+    batch_tree.take_tuple_batch(*transitions)
+    rows.append(("cpp", "take_tuple_batch", len(transitions[1]), time.perf_counter() - start))
+
+    states = transitions[0]
+    rows.append(("cpp", "select_a", len(states),
+                 time_calls(cpp_tree.select_a, [(convert_to_pystate(s),) for s in states]).sum()))
+    rows.append(("python", "select_a", len(states), time_calls(py_tree.select_a, [(s,) for s in states]).sum()))
+    if not all(cpp_tree.select_a(convert_to_pystate(s)) == py_tree.select_a(s) for s in states):
+        differences.append("select_a differs")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = os.path.join(tmp_dir, "DT.txt").encode()
+        rows.append(("cpp", "save", repetitions, time_calls(cpp_tree.save_to_file, [(filename,)] * repetitions).sum()))
+        differences.extend(compare_trees(read_cpp_tree(filename), read_py_tree(py_tree), tolerance))
+        batch_filename = os.path.join(tmp_dir, "batch_DT.txt").encode()
+        batch_tree.save_to_file(batch_filename)
+        differences.extend("take_tuple_batch: " + difference for difference in
+                           compare_trees(read_cpp_tree(batch_filename), read_py_tree(py_tree), tolerance))
+        loaded_tree, _ = make_trees(params)
+        rows.append(("cpp", "load", repetitions,
+                     time_calls(loaded_tree.set_root_from_file, [(filename,)] * repetitions).sum()))
+
+    state = cpp_tree.get_state()
+    rows.append(("cpp", "get_state", repetitions, time_calls(cpp_tree.get_state, [()] * repetitions).sum()))
+    rows.append(("cpp", "set_state", repetitions,
+                 time_calls(loaded_tree.set_state, [(state,)] * repetitions).sum()))
+    data = pickle.dumps(py_tree)
+    rows.append(("python", "save", repetitions, time_calls(pickle.dumps, [(py_tree,)] * repetitions).sum()))
+    rows.append(("python", "load", repetitions, time_calls(pickle.loads, [(data,)] * repetitions).sum()))
+    return rows, differences
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check that the Python and C++ QTrees build the same tree from the same "
+                                                 "transitions, and time their operations (exits 1 if they differ).")
+    parser.add_argument("--steps", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-episode-steps", type=int, default=200)
+    parser.add_argument("--repetitions", type=int, default=10, help="of save and load")
+    parser.add_argument("--tolerance", type=float, default=1e-9)
+    parser.add_argument("--gamma", type=float, default=0.8)
+    parser.add_argument("--alpha", type=float, default=0.01)
+    parser.add_argument("--split-thresh-max", type=float, default=1000)
+    parser.add_argument("--num-splits", type=int, default=3)
+    parser.add_argument("--output", default=None, help="csv file with the timings")
+    args = parser.parse_args()
+
+    params = dict(gamma=args.gamma, alpha=args.alpha, visit_decay=0.999, split_thresh_max=args.split_thresh_max,
+                  split_thresh_decay=0.99, num_splits=args.num_splits)
+    rows, differences = run(transition_stream(args.seed, args.steps, args.max_episode_steps), params,
+                            args.repetitions, args.tolerance)
+
+    lines = [CSV_HEADER] + ["%s,%s,%d,%.6f,%.3f" % (implementation, op, calls, seconds,
+                                                      seconds / calls * 1e6 if calls else float("nan"))
+                            for implementation, op, calls, seconds in rows]
+    print("\n".join(lines))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+    for difference in differences:
+        print(difference, file=sys.stderr)
+    sys.exit(1 if differences else 0)
@@ -0,0 +1,59 @@
+#ifndef EXPLCACHE_H
+#define EXPLCACHE_H
+#include <vector>
+#include <list>
+#include <utility>
+#include <cstdint>
+#include <functional>
+#include <unordered_map>
+
+using namespace std;
+
+struct ExplanationKey {
+    uintptr_t leafId;       // address of the leaf reached by the state
+    int action;
+    int userAction;         // -1 for classic explanations
+    bool usingHigherNodes;
+    uint64_t history;       // fingerprint of alreadyExplained[action]
+
+    bool operator==(const ExplanationKey& other) const {
+        return leafId == other.leafId && action == other.action && userAction == other.userAction &&
+        usingHigherNodes == other.usingHigherNodes && history == other.history;
+    }
+};
+
+struct ExplanationKeyHash {
+    size_t operator()(const ExplanationKey& key) const {
+        size_t h = hash<uintptr_t>()(key.leafId);
+        h ^= hash<int>()(key.action) + 0x9e3779b9 + (h << 6) + (h >> 2);
+        h ^= hash<int>()(key.userAction) + 0x9e3779b9 + (h << 6) + (h >> 2);
+        h ^= hash<bool>()(key.usingHigherNodes) + 0x9e3779b9 + (h << 6) + (h >> 2);
+        h ^= hash<uint64_t>()(key.history) + 0x9e3779b9 + (h << 6) + (h >> 2);
+        return h;
+    }
+};
+
+struct ExplanationEntry {
+    vector<double> explanation;     // {feature, direction, value}
+    bool historyReset;              // true if all the explanations had already been given
+};
+
+class ExplanationCache {
+    public:
+        size_t capacity;
+        long hits;
+        long misses;
+
+        ExplanationCache(size_t);
+
+        bool get(const ExplanationKey&, ExplanationEntry&);
+        void put(const ExplanationKey&, const ExplanationEntry&);
+        void setCapacity(size_t);
+        void clear();
+        size_t size();
+
+    private:
+        list<pair<ExplanationKey, ExplanationEntry>> entries;   // most recently used first
+        unordered_map<ExplanationKey, list<pair<ExplanationKey, ExplanationEntry>>::iterator, ExplanationKeyHash> index;
+};
+#endif
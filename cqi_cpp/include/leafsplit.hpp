@@ -18,7 +18,7 @@ class LeafSplit {
         LeafSplit(int, double, vector<double>*, vector<double>*, double, double);
         ~LeafSplit();
 
-        void update(State*, Action*, int, unordered_map<string, double>*);
+        void update(State*, Action*, double, unordered_map<string, double>*);
         double evalUtility(vector<double>*);
 };
 #endif
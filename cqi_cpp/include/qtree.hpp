@@ -1,4 +1,5 @@
 #include "qfunc.hpp"
+#include "explcache.hpp"
 
 #include <string>
 #include <iostream>
@@ -8,6 +9,7 @@
 #include <stack>
 #include <utility>
 #include <tuple>
+#include <limits>
 
 using std::ofstream;
 using std::ifstream;
@@ -19,6 +21,36 @@ struct infoNode {
     string direction;   // left - right
 };
 
+enum ExplanationType {
+    NO_EXPLANATION = 0,
+    CLASSIC_EXPLANATION = 1,
+    USERAWARE_EXPLANATION = 2
+};
+
+struct InfoWeight {
+    int feature;
+    double direction;   // -1.0 left, 1.0 right
+    double value1;      // threshold of the higher node
+    double value2;      // threshold of the deeper node
+};
+
+struct TreeStats {
+    int numNodes;
+    int numLeaves;
+    vector<long> depthHistogram;    // number of leaves per depth (root at depth 0)
+    vector<long> featureSplits;     // number of internal nodes per feature
+    vector<long> leafActions;       // number of leaves per greedy action
+    vector<double> leafVisits;      // pre-order
+    vector<double> internalVisits;  // pre-order
+};
+
+struct Decision {
+    int action;
+    vector<double> qs;
+    uintptr_t leafId;               // address of the leaf selecting the action
+    vector<double> explanation;     // {feature, direction, value}, empty if not requested
+};
+
 
 
 class QTree: public QFunc {
@@ -28,32 +60,58 @@ class QTree: public QFunc {
         bool _justSplit;
         unordered_map<string, double>* params;
         vector<tuple<int, string, double>> alreadyExplained[12];
+        uint64_t alreadyExplainedHash[12];
+        ExplanationCache* explanationCache;
 
         QTree(Box*, Discrete*, QTreeNode*, double, double, double, double, double, int);
         ~QTree();
         void destroyEverything();
         void deallocateDT(QTreeNode* node);
+        void deallocateNodes(QTreeNode* node);
+        void replaceRoot(QTreeNode* root);
         int selectA(State*);
         void takeTuple(State*, Action*, double, State*, bool);
+        int takeTupleBatch(const double* s, const int* a, const double* r, const double* s2, const unsigned char* done,
+                           int batchSize, int stateSize);
         void update(State*, Action*, double, State*, bool);
         int numNodes();
         void printStructure();
         bool justSplit();
         bool saveToFile(string path);
         void saveToFileRecursive(ofstream &outdata, QTreeNode* node);
-        bool setRootFromFile(string path);
-        QTreeNode* setRootFromFileRecursive(ifstream &indata);
+        bool setRootFromFile(string path, bool loadParams);
+        QTreeNode* setRootFromFileRecursive(ifstream &indata, vector<double> low, vector<double> high);
+        vector<LeafSplit*>* defaultSplits(vector<double>* qs, vector<double>& low, vector<double>& high);
+        string serializeState();
+        void collectVectors(QTreeNode* node, unordered_map<vector<double>*, uint64_t>& ids, vector<vector<double>*>& vectors);
+        void serializeNode(ostream& out, QTreeNode* node, unordered_map<vector<double>*, uint64_t>& ids);
+        bool deserializeState(string data);
+        bool deserializeNode(istream& in, const string& data, vector<vector<double>*>& vectors, QTreeNode*& node,
+                             int depth);
         void infoWeightAnalysis(string path);
+        vector<InfoWeight> infoWeights();
+        void infoWeightsRecursive(QTreeNode* node, vector<vector<double>>& pathValues, vector<InfoWeight>& result);
+        QTreeNode* findExplanationLeaf(vector<double>& state);
+        Decision decide(vector<double> state, int explanationType, int userAction, bool usingHigherNodes);
         vector<double> explain_useraware(int user_action, int action, vector<double> state, bool usingHigherNodes);
+        vector<double> explainUserawareAtLeaf(QTreeNode* leaf, int user_action, int action, vector<double>& state);
+        vector<double> computeExplanationUseraware(int user_action, int action, vector<double>& state);
         vector<QTreeNode*> findUserActionLeafs(int user_action);
         void findUserActionLeafsRecursive(QTreeNode* parent, int user_action, vector<QTreeNode*>& curr_user_actions);
         int computeLeafToLeafDistance(QTreeNode* icubAction, QTreeNode* userAction, infoNode lowestCommonAncestor);
         infoNode getLowestCommonAncestor(QTreeNode* root, QTreeNode* node1, QTreeNode* node2);
         int distanceBetweenNodes(QTreeNode* ancestor, QTreeNode* node, int distance);
         vector<double> explain_classic(int action, vector<double> state, bool usingHigherNodes);
+        vector<double> explainClassicAtLeaf(QTreeNode* leaf, int action, vector<double>& state, bool usingHigherNodes);
+        ExplanationEntry computeExplanationClassic(int action, vector<double>& state, bool usingHigherNodes);
         void addTupleToAlreadyExplained(int action, double feature, double direction, double value);
-        vector<infoNode> deleteFeaturesAlreadyExplained(int action, vector<infoNode> visited);
+        void clearAlreadyExplained(int action);
+        vector<double> getAlreadyExplained(int action);
+        void setAlreadyExplained(int action, vector<double> history);
+        vector<infoNode> deleteFeaturesAlreadyExplained(int action, vector<infoNode> visited, bool& historyReset);
         vector<infoNode> deleteUselessInfoNodes(vector<infoNode> visited, bool usingHigherNodes);
         double getAverageDepth();
+        TreeStats treeStats();
+        void treeStatsRecursive(QTreeNode* node, int depth, TreeStats& stats);
         void recursiveDepth(QTreeNode* parent, int& parentDepth, int& accumulateDepth, int& nodeCount);
 };
@@ -0,0 +1,58 @@
+#include "../include/explcache.hpp"
+
+ExplanationCache::ExplanationCache(size_t capacity) {
+    this->capacity = capacity;
+    this->hits = 0;
+    this->misses = 0;
+}
+
+bool ExplanationCache::get(const ExplanationKey& key, ExplanationEntry& entry) {
+    auto it = this->index.find(key);
+    if (it == this->index.end()) {
+        this->misses++;
+        return false;
+    }
+
+    // move the entry in front: it is now the most recently used
+    this->entries.splice(this->entries.begin(), this->entries, it->second);
+    entry = it->second->second;
+    this->hits++;
+    return true;
+}
+
+void ExplanationCache::put(const ExplanationKey& key, const ExplanationEntry& entry) {
+    if (this->capacity == 0) return;
+
+    auto it = this->index.find(key);
+    if (it != this->index.end()) {
+        it->second->second = entry;
+        this->entries.splice(this->entries.begin(), this->entries, it->second);
+        return;
+    }
+
+    this->entries.push_front(pair<ExplanationKey, ExplanationEntry>(key, entry));
+    this->index[key] = this->entries.begin();
+
+    // evict the least recently used entries
+    while (this->entries.size() > this->capacity) {
+        this->index.erase(this->entries.back().first);
+        this->entries.pop_back();
+    }
+}
+
+void ExplanationCache::setCapacity(size_t capacity) {
+    this->capacity = capacity;
+    while (this->entries.size() > this->capacity) {
+        this->index.erase(this->entries.back().first);
+        this->entries.pop_back();
+    }
+}
+
+void ExplanationCache::clear() {
+    this->entries.clear();
+    this->index.clear();
+}
+
+size_t ExplanationCache::size() {
+    return this->entries.size();
+}
@@ -16,7 +16,7 @@ LeafSplit::~LeafSplit() {
     delete rightQS;
 }
 
-void LeafSplit::update(State* s, Action* a, int target, unordered_map<string, 
+void LeafSplit::update(State* s, Action* a, double target, unordered_map<string, 
     double>* params) {
 
     double visitDecay = params->at("visitDecay");
@@ -3,6 +3,11 @@
 
 typedef unordered_map<string, double> map;
 
+// number of explanations kept in the LRU cache
+const size_t EXPLANATION_CACHE_SIZE = 1024;
+// seed of the alreadyExplained fingerprints (empty history)
+const uint64_t EMPTY_HISTORY_HASH = 14695981039346656037ULL;
+
 
 /*
     UTIL FUNCTIONS
@@ -30,9 +35,9 @@ QTree::QTree(Box* stateSpace, Discrete* actionSpace, QTreeNode* root=nullptr,
 
         for (size_t f = 0; f < low->size(); f++) {
             for (int i = 0; i < numSplits; i++) {
-                vector<double>* zerosVector = Utils::zeros(actionSpace->size());
-                int value = low->at(f) + (high->at(f) - low->at(f))/(numSplits + 1) * (i + 1);
-                LeafSplit* toAdd = new LeafSplit(f, value, zerosVector, zerosVector, 0.5, 0.5);
+                double value = low->at(f) + (high->at(f) - low->at(f))/(numSplits + 1) * (i + 1);
+                LeafSplit* toAdd = new LeafSplit(f, value, Utils::zeros(actionSpace->size()),
+                    Utils::zeros(actionSpace->size()), 0.5, 0.5);
                 
                 splits->push_back(toAdd);
             }
@@ -53,6 +58,11 @@ QTree::QTree(Box* stateSpace, Discrete* actionSpace, QTreeNode* root=nullptr,
     this->splitThreshDecay = splitThreshDecay;
     this->splitThresh = this->splitThreshMax;
     this->_justSplit = false;  // True if the most recent action resulted in a split
+
+    this->explanationCache = new ExplanationCache(EXPLANATION_CACHE_SIZE);
+    for(int i = 0; i < 12; i++) {
+        this->alreadyExplainedHash[i] = EMPTY_HISTORY_HASH;
+    }
 }
 
 QTree::~QTree() {
@@ -61,6 +71,7 @@ QTree::~QTree() {
 
 void QTree::destroyEverything() {
     delete this->params;
+    delete this->explanationCache;
     for(auto x : alreadyExplained) {
         x.clear();
     }
@@ -69,19 +80,47 @@ void QTree::destroyEverything() {
 }
 
 void QTree::deallocateDT(QTreeNode* node) {
+    // the Q-value vectors may be shared (see the training state below): they are collected first and deleted once
+    unordered_map<vector<double>*, uint64_t> ids;
+    vector<vector<double>*> vectors;
+    this->collectVectors(node, ids, vectors);
+    this->deallocateNodes(node);
+    for(vector<double>* v : vectors) {
+        delete v;
+    }
+}
+
+void QTree::deallocateNodes(QTreeNode* node) {
+    // nodes and split candidates only, their Q-value vectors are left to the caller
     if(node == nullptr) return;
     if(node->isLeaf()) {
         QTreeLeaf* curr = dynamic_cast<QTreeLeaf*>(node);
+        if(curr->splits != nullptr) {
+            for(LeafSplit* split : *(curr->splits)) {
+                split->leftQS = nullptr;
+                split->rightQS = nullptr;
+                delete split;
+            }
+        }
+        curr->qs = nullptr;
         delete curr;
     }
     else {
         QTreeInternal* curr = dynamic_cast<QTreeInternal*>(node);
-        deallocateDT(curr->leftChild);
-        deallocateDT(curr->rightChild);
+        deallocateNodes(curr->leftChild);
+        deallocateNodes(curr->rightChild);
         delete curr;
     }
 }
 
+void QTree::replaceRoot(QTreeNode* root) {
+    // a pre-split copy shares the previous nodes, which are freed here
+    this->selfCopy = nullptr;
+    this->deallocateDT(this->root);
+    this->root = root;
+    this->explanationCache->clear();
+}
+
 
 int QTree::selectA(State* s) {
     return Utils::argmax(this->root->getQS(s));
@@ -114,6 +153,31 @@ void QTree::takeTuple(State* s, Action* a, double r, State* s2, bool done) {
     }
 }
 
+int QTree::takeTupleBatch(const double* s, const int* a, const double* r, const double* s2, const unsigned char* done,
+                          int batchSize, int stateSize) {
+    // row-major arrays of batchSize transitions, taken in order; the states are reused across the batch
+    vector<double>* sVector = new vector<double>(stateSize);
+    vector<double>* s2Vector = new vector<double>(stateSize);
+    State state(sVector);
+    State nextState(s2Vector);
+    Action action(0);
+    int numSplits = 0;
+
+    for(int i = 0; i < batchSize; i++) {
+        copy(s + i * stateSize, s + (i + 1) * stateSize, sVector->begin());
+        copy(s2 + i * stateSize, s2 + (i + 1) * stateSize, s2Vector->begin());
+        action.value = a[i];
+        this->takeTuple(&state, &action, r[i], &nextState, done[i]);
+        if(this->_justSplit) {
+            numSplits++;
+        }
+    }
+
+    delete sVector;
+    delete s2Vector;
+    return numSplits;
+}
+
 void QTree::update(State* s, Action* a, double r, State* s2, bool done) {
     double target = 0;
 
@@ -127,6 +191,11 @@ void QTree::update(State* s, Action* a, double r, State* s2, bool done) {
     }
 
     this->root->update(s, a, target, this->params);
+
+    // Q-values (and possibly the structure) changed: cached explanations are stale
+    if(this->explanationCache->size() > 0) {
+        this->explanationCache->clear();
+    }
 }
 
 int QTree::numNodes() {
@@ -144,6 +213,23 @@ bool QTree::justSplit() {
 bool QTree::saveToFile(string path) {
     ofstream outdata;
     outdata.open(path,  ios::out | ios::binary);
+    outdata.precision(numeric_limits<double>::max_digits10);
+
+    // training parameters and state space bounds, so that a loaded tree can keep training
+    outdata << "params gamma " << this->params->at("gamma") << " alpha " << this->params->at("alpha") <<
+    " visitDecay " << this->params->at("visitDecay") << " numSplits " << this->params->at("numSplits") <<
+    " splitThreshMax " << this->splitThreshMax << " splitThreshDecay " << this->splitThreshDecay <<
+    " splitThresh " << this->splitThresh << endl;
+    outdata << "bounds low ";
+    for(double l : *(this->stateSpace->low)) {
+        outdata << l << " ";
+    }
+    outdata << "high ";
+    for(double h : *(this->stateSpace->high)) {
+        outdata << h << " ";
+    }
+    outdata << endl;
+
     saveToFileRecursive(outdata, root);
     outdata.close();
     return true;
@@ -167,18 +253,41 @@ void QTree::saveToFileRecursive(ofstream &outdata, QTreeNode* n) {
         hasLeftChild = false;
         hasRightChild = false;
         qs = node->qs;
+        size_t numSplits = node->splits == nullptr ? 0 : node->splits->size();
 
         // write info
         outdata << "leaf " << "visits " << visits << " qs ";
         for(double q : *qs) {
             outdata << q << " ";
         }
-        outdata << endl;
+        outdata << "splits " << numSplits << endl;
+
+        // one line per split candidate
+        for(size_t i = 0; i < numSplits; i++) {
+            LeafSplit* split = node->splits->at(i);
+            outdata << "split feature " << split->feature << " value " << split->value << " leftVisits " <<
+            split->leftVisits << " rightVisits " << split->rightVisits << " leftQs ";
+            for(double q : *(split->leftQS)) {
+                outdata << q << " ";
+            }
+            if(split->rightQS == split->leftQS) {
+                // the same vector is updated from both sides (root candidates of trees built by older versions)
+                outdata << "rightQs shared" << endl;
+            }
+            else {
+                outdata << "rightQs ";
+                for(double q : *(split->rightQS)) {
+                    outdata << q << " ";
+                }
+                outdata << endl;
+            }
+        }
     }
     else {
         QTreeInternal *node = dynamic_cast<QTreeInternal*>(n);
 
-        // retrieve internal info
+        // retrieve internal info (the internal node keeps its own visits, updated during training)
+        visits = node->visits;
         feature = node->feature;
         value = node->value;
         if(node->leftChild->numNodes() > 0) {
@@ -213,30 +322,70 @@ void QTree::saveToFileRecursive(ofstream &outdata, QTreeNode* n) {
 
 }
 
-bool QTree::setRootFromFile(string path) {
+vector<string> splitBySpace(string line) {
+    stringstream ss(line);
+    vector<string> splitLine;
+    string s;
+    while(getline(ss, s, ' ')) {
+        if(!s.empty()) {
+            splitLine.push_back(s);
+        }
+    }
+    return splitLine;
+}
+
+bool QTree::setRootFromFile(string path, bool loadParams) {
     ifstream indata;
     indata.open(path);
-    root = setRootFromFileRecursive(indata);
+
+    // files saved before the training state was added start directly with the root
+    vector<double> low = *(this->stateSpace->low);
+    vector<double> high = *(this->stateSpace->high);
+    streampos nodesStart = indata.tellg();
+    string line;
+    while(getline(indata, line)) {
+        vector<string> splitLine = splitBySpace(line);
+        if(!splitLine.empty() && splitLine[0] == "params") {
+            // the ones given to the constructor are kept, unless the caller continues the saved training
+            if(loadParams) {
+                (*this->params)["gamma"] = stod(splitLine[2]);
+                (*this->params)["alpha"] = stod(splitLine[4]);
+                (*this->params)["visitDecay"] = stod(splitLine[6]);
+                (*this->params)["numSplits"] = stod(splitLine[8]);
+                this->splitThreshMax = stod(splitLine[10]);
+                this->splitThreshDecay = stod(splitLine[12]);
+                this->splitThresh = stod(splitLine[14]);
+            }
+        }
+        else if(!splitLine.empty() && splitLine[0] == "bounds") {
+            size_t n = this->stateSpace->low->size();
+            for(size_t i = 0; i < n; i++) {
+                this->stateSpace->low->at(i) = stod(splitLine[2 + i]);
+                this->stateSpace->high->at(i) = stod(splitLine[3 + n + i]);
+            }
+        }
+        else {
+            break;
+        }
+        nodesStart = indata.tellg();
+    }
+    indata.clear();
+    indata.seekg(nodesStart);
+
+    this->replaceRoot(setRootFromFileRecursive(indata, low, high));
     indata.close();
     return true;
 }
 
-QTreeNode* QTree::setRootFromFileRecursive(ifstream& indata) {
+QTreeNode* QTree::setRootFromFileRecursive(ifstream& indata, vector<double> low, vector<double> high) {
     // read line from file
     string line;
     getline(indata, line);
 
     // split line by space
-    stringstream ss(line);
-    vector<string> splitLine;
-    string s;
-    while(getline(ss, s, ' ')) {
-        splitLine.push_back(s);
-    }
+    vector<string> splitLine = splitBySpace(line);
 
     double visits = stod(splitLine[2]);
-    //cout << splitLine[2] << " " << visits << endl;
-    //QTreeNode* node = nullptr;
 
     if(splitLine[0] == "internal") {
         // retrieve internal info and create internal node
@@ -244,17 +393,19 @@ QTreeNode* QTree::setRootFromFileRecursive(ifstream& indata) {
         double value = stod(splitLine[6]);
         QTreeInternal* node = new QTreeInternal(nullptr, nullptr, feature, value, visits);
 
-        //cout << splitLine[0] << " visits " << visits << " feature " << feature << " value " << value << endl;
-
-        // recursive calls
+        // recursive calls, with the region of each child
         if(splitLine[8] == "1") {
-            node->leftChild = setRootFromFileRecursive(indata);
+            vector<double> leftHigh = high;
+            leftHigh[feature] = value;
+            node->leftChild = setRootFromFileRecursive(indata, low, leftHigh);
         }
         else {
             node->leftChild = nullptr;
         }
         if(splitLine[10] == "1") {
-            node->rightChild = setRootFromFileRecursive(indata);
+            vector<double> rightLow = low;
+            rightLow[feature] = value;
+            node->rightChild = setRootFromFileRecursive(indata, rightLow, high);
         }
         else {
             node->rightChild = nullptr;
@@ -264,132 +415,457 @@ QTreeNode* QTree::setRootFromFileRecursive(ifstream& indata) {
     }
     else {
         // retrieve leaf info and create leaf
+        auto splitsToken = find(splitLine.begin(), splitLine.end(), "splits");
         vector<double>* qs = new vector<double>();
-        auto first = splitLine.begin() + 4;
-        auto last = splitLine.end();
-        vector<string> qsValues(first, last);
-        for(string qVal : qsValues) {
-            qs->push_back(stod(qVal));
+        for(auto it = splitLine.begin() + 4; it != splitsToken; it++) {
+            qs->push_back(stod(*it));
         }
-        QTreeLeaf* node = new QTreeLeaf(qs, visits, nullptr);
 
-        /*
-        cout << splitLine[0] << " visits " << visits << " qs ";
-        for(double q : *qs) {
-            cout << q << " ";
+        vector<LeafSplit*>* splits;
+        if(splitsToken == splitLine.end()) {
+            // no split candidates saved: new ones over the leaf's region, as after a split
+            splits = this->defaultSplits(qs, low, high);
         }
-        cout << endl;
-        */
+        else {
+            splits = new vector<LeafSplit*>();
+            int numSplits = stoi(*(splitsToken + 1));
+            for(int i = 0; i < numSplits; i++) {
+                getline(indata, line);
+                vector<string> splitTokens = splitBySpace(line);
+                auto leftToken = find(splitTokens.begin(), splitTokens.end(), "leftQs");
+                auto rightToken = find(splitTokens.begin(), splitTokens.end(), "rightQs");
+
+                vector<double>* leftQS = new vector<double>();
+                for(auto it = leftToken + 1; it != rightToken; it++) {
+                    leftQS->push_back(stod(*it));
+                }
+                vector<double>* rightQS = leftQS;
+                if(*(rightToken + 1) != "shared") {
+                    rightQS = new vector<double>();
+                    for(auto it = rightToken + 1; it != splitTokens.end(); it++) {
+                        rightQS->push_back(stod(*it));
+                    }
+                }
 
-        return node;
+                splits->push_back(new LeafSplit(stoi(splitTokens[2]), stod(splitTokens[4]), leftQS, rightQS,
+                                                stod(splitTokens[6]), stod(splitTokens[8])));
+            }
+        }
+
+        return new QTreeLeaf(qs, visits, splits);
     }
 }
 
-void QTree::infoWeightAnalysis(string path) {
-    ofstream outdata;
-    outdata.open(path);
-    std::stack<infoNode> stack;
-    std::stack<infoNode> visitStack;
-    QTreeNode* curr = this->root;
-    string lastDirection;
+vector<LeafSplit*>* QTree::defaultSplits(vector<double>* qs, vector<double>& low, vector<double>& high) {
+    vector<LeafSplit*>* splits = new vector<LeafSplit*>();
+    int numSplits = this->params->at("numSplits");
 
-    while(!stack.empty() || curr != nullptr) {
-        if(curr != nullptr) {
+    for(size_t f = 0; f < low.size(); f++) {
+        for(int i = 0; i < numSplits; i++) {
+            double value = low[f] + (high[f] - low[f]) / (numSplits + 1) * (i + 1);
+            splits->push_back(new LeafSplit(f, value, Utils::copy(qs), Utils::copy(qs), 0.5, 0.5));
+        }
+    }
+    return splits;
+}
 
-            // visit leaf
-            if(curr->isLeaf()) {
-                //QTreeLeaf* leaf = dynamic_cast<QTreeLeaf*>(curr);
+/*
+    TRAINING STATE (binary): training parameters, then the table of the Q-value vectors, then the nodes in pre-order.
+    Vectors are referred to by index, since they may be shared: in trees built by older versions, the root's first
+    splits had the same left and right Qs, and so did the first two children of the root. An exact resume of such a
+    state needs the same sharing.
+    The state space bounds are included as well, since splits narrow them in place.
+*/
 
-                if(visitStack.empty()) {
-                    visitStack = stack;
-                }
+const char STATE_MAGIC[4] = {'C', 'Q', 'I', 'S'};
+const uint32_t STATE_VERSION = 1;
+const uint8_t INTERNAL_NODE = 0, LEAF_NODE = 1, NULL_NODE = 2;
+// deeper trees are rejected as corrupt, before running out of stack
+const int MAX_STATE_DEPTH = 10000;
 
-                vector<pair<double, string>> infoArray[8];
-                while(!visitStack.empty()) {
-                    infoNode info = visitStack.top();
-                    visitStack.pop();
-                    int feature;
-                    double value;
+template <typename T>
+static void writeBinary(ostream& out, T value) {
+    out.write(reinterpret_cast<const char*>(&value), sizeof(T));
+}
 
-                    if(!info.node->isLeaf()) {
-                        feature = dynamic_cast<QTreeInternal*>(info.node)->feature;
-                        value = dynamic_cast<QTreeInternal*>(info.node)->value;
-                    }
+template <typename T>
+static bool readBinary(istream& in, T& value) {
+    in.read(reinterpret_cast<char*>(&value), sizeof(T));
+    return (bool) in;
+}
 
-                    string dir = lastDirection;
-                    pair<double, string> couple = pair<double, string>(value, dir);
-                    infoArray[feature].insert(infoArray[feature].end(), couple);
-                }
+static uint64_t remainingBytes(istream& in, const string& data) {
+    streamoff position = in.tellg();
+    return position < 0 ? 0 : data.size() - (uint64_t) position;
+}
 
-                for(int index = 0; index < 8; index++) {
-                    if(infoArray[index].size() > 1) {
-                        for(uint i = 0; i < infoArray[index].size(); i++) {
-                            for(uint j = 0; j < infoArray[index].size(); j++) {
-                                if(i != j) {
-                                    pair<double, string> currInfo_1 = infoArray[index][i];
-                                    pair<double, string> currInfo_2 = infoArray[index][j];
-                                    if(currInfo_1.second == currInfo_2.second) {
-                                        outdata << "feature " << index << " direction " << currInfo_1.second << " value 1 " <<
-                                        currInfo_1.first << " value 2 " << currInfo_2.first << endl;
-                                    }
-                                }
-                            }
-                        }
-                    }
-                }
-            }
+string QTree::serializeState() {
+    ostringstream out(ios::out | ios::binary);
+    out.write(STATE_MAGIC, 4);
+    writeBinary<uint32_t>(out, STATE_VERSION);
+
+    writeBinary<double>(out, this->params->at("gamma"));
+    writeBinary<double>(out, this->params->at("alpha"));
+    writeBinary<double>(out, this->params->at("visitDecay"));
+    writeBinary<double>(out, this->params->at("numSplits"));
+    writeBinary<double>(out, this->splitThreshMax);
+    writeBinary<double>(out, this->splitThreshDecay);
+    writeBinary<double>(out, this->splitThresh);
+    writeBinary<uint8_t>(out, this->_justSplit);
+    for(vector<double>* bounds : {this->stateSpace->low, this->stateSpace->high}) {
+        writeBinary<uint64_t>(out, bounds->size());
+        out.write(reinterpret_cast<const char*>(bounds->data()), bounds->size() * sizeof(double));
+    }
 
-            infoNode info = {curr, lastDirection};
-            stack.push(info);
-            if(curr->isLeaf()) {
-                curr = nullptr;
-            }
-            else {
-                QTreeInternal* tmpInternal = dynamic_cast<QTreeInternal*>(curr);
-                QTreeNode* tmpNode = tmpInternal->leftChild;
-                curr = tmpNode;
-                lastDirection = "left";
+    unordered_map<vector<double>*, uint64_t> ids;
+    vector<vector<double>*> vectors;
+    this->collectVectors(this->root, ids, vectors);
+    writeBinary<uint64_t>(out, vectors.size());
+    for(vector<double>* v : vectors) {
+        writeBinary<uint64_t>(out, v->size());
+        out.write(reinterpret_cast<const char*>(v->data()), v->size() * sizeof(double));
+    }
+
+    this->serializeNode(out, this->root, ids);
+    return out.str();
+}
+
+void QTree::collectVectors(QTreeNode* node, unordered_map<vector<double>*, uint64_t>& ids, vector<vector<double>*>& vectors) {
+    if(node == nullptr) return;
+
+    if(node->isLeaf()) {
+        QTreeLeaf* leaf = dynamic_cast<QTreeLeaf*>(node);
+        vector<vector<double>*> leafVectors = {leaf->qs};
+        if(leaf->splits != nullptr) {
+            for(LeafSplit* split : *(leaf->splits)) {
+                leafVectors.push_back(split->leftQS);
+                leafVectors.push_back(split->rightQS);
             }
         }
-        else {
-            visitStack = stack;
-            infoNode info = stack.top();
-            curr = info.node;
-            stack.pop();
-            if(curr->isLeaf()) {
-                curr = nullptr;
+        for(vector<double>* v : leafVectors) {
+            if(ids.find(v) == ids.end()) {
+                ids[v] = vectors.size();
+                vectors.push_back(v);
             }
-            else {
-                QTreeInternal* tmpInternal = dynamic_cast<QTreeInternal*>(curr);
-                QTreeNode* tmpNode = tmpInternal->rightChild;
-                curr = tmpNode;
-                lastDirection = "right";
+        }
+    }
+    else {
+        QTreeInternal* internal = dynamic_cast<QTreeInternal*>(node);
+        this->collectVectors(internal->leftChild, ids, vectors);
+        this->collectVectors(internal->rightChild, ids, vectors);
+    }
+}
+
+void QTree::serializeNode(ostream& out, QTreeNode* node, unordered_map<vector<double>*, uint64_t>& ids) {
+    if(node == nullptr) {
+        writeBinary<uint8_t>(out, NULL_NODE);
+        return;
+    }
+
+    if(node->isLeaf()) {
+        QTreeLeaf* leaf = dynamic_cast<QTreeLeaf*>(node);
+        writeBinary<uint8_t>(out, LEAF_NODE);
+        writeBinary<double>(out, leaf->visits);
+        writeBinary<uint64_t>(out, ids[leaf->qs]);
+
+        size_t numSplits = leaf->splits == nullptr ? 0 : leaf->splits->size();
+        writeBinary<uint64_t>(out, numSplits);
+        for(size_t i = 0; i < numSplits; i++) {
+            LeafSplit* split = leaf->splits->at(i);
+            writeBinary<int32_t>(out, split->feature);
+            writeBinary<double>(out, split->value);
+            writeBinary<uint64_t>(out, ids[split->leftQS]);
+            writeBinary<uint64_t>(out, ids[split->rightQS]);
+            writeBinary<double>(out, split->leftVisits);
+            writeBinary<double>(out, split->rightVisits);
+        }
+    }
+    else {
+        QTreeInternal* internal = dynamic_cast<QTreeInternal*>(node);
+        writeBinary<uint8_t>(out, INTERNAL_NODE);
+        writeBinary<double>(out, internal->visits);
+        writeBinary<int32_t>(out, internal->feature);
+        writeBinary<double>(out, internal->value);
+        this->serializeNode(out, internal->leftChild, ids);
+        this->serializeNode(out, internal->rightChild, ids);
+    }
+}
+
+bool QTree::deserializeState(string data) {
+    // the state is checked while it is read: on any inconsistency nothing is changed and false is returned
+    istringstream in(data, ios::in | ios::binary);
+    char magic[4];
+    uint32_t version;
+    in.read(magic, 4);
+    if(!in || !equal(magic, magic + 4, STATE_MAGIC) || !readBinary(in, version) || version != STATE_VERSION) {
+        return false;
+    }
+
+    double gamma, alpha, visitDecay, numSplits, splitThreshMax, splitThreshDecay, splitThresh;
+    uint8_t justSplit;
+    if(!readBinary(in, gamma) || !readBinary(in, alpha) || !readBinary(in, visitDecay) || !readBinary(in, numSplits) ||
+       !readBinary(in, splitThreshMax) || !readBinary(in, splitThreshDecay) || !readBinary(in, splitThresh) ||
+       !readBinary(in, justSplit)) {
+        return false;
+    }
+    size_t numFeatures = this->stateSpace->low->size();
+    vector<double> low(numFeatures), high(numFeatures);
+    for(vector<double>* bounds : {&low, &high}) {
+        uint64_t size;
+        if(!readBinary(in, size) || size != numFeatures) {
+            return false;
+        }
+        in.read(reinterpret_cast<char*>(bounds->data()), size * sizeof(double));
+        if(!in) {
+            return false;
+        }
+    }
+
+    // every vector has a Q-value per action
+    uint64_t numVectors;
+    size_t numActions = this->actionSpace->size();
+    if(!readBinary(in, numVectors) ||
+       numVectors > remainingBytes(in, data) / (sizeof(uint64_t) + numActions * sizeof(double))) {
+        return false;
+    }
+    vector<vector<double>*> vectors;
+    bool valid = true;
+    for(uint64_t i = 0; i < numVectors && valid; i++) {
+        uint64_t size;
+        valid = readBinary(in, size) && size == numActions;
+        if(valid) {
+            vector<double>* v = new vector<double>(size);
+            vectors.push_back(v);
+            in.read(reinterpret_cast<char*>(v->data()), size * sizeof(double));
+            valid = (bool) in;
+        }
+    }
+
+    QTreeNode* root = nullptr;
+    if(valid) {
+        valid = this->deserializeNode(in, data, vectors, root, 0) && root != nullptr && in.peek() == EOF;
+    }
+    if(!valid) {
+        this->deallocateNodes(root);
+        for(vector<double>* v : vectors) {
+            delete v;
+        }
+        return false;
+    }
+
+    // vectors which no node refers to
+    unordered_map<vector<double>*, uint64_t> ids;
+    vector<vector<double>*> used;
+    this->collectVectors(root, ids, used);
+    for(vector<double>* v : vectors) {
+        if(ids.find(v) == ids.end()) {
+            delete v;
+        }
+    }
+
+    (*this->params)["gamma"] = gamma;
+    (*this->params)["alpha"] = alpha;
+    (*this->params)["visitDecay"] = visitDecay;
+    (*this->params)["numSplits"] = numSplits;
+    this->splitThreshMax = splitThreshMax;
+    this->splitThreshDecay = splitThreshDecay;
+    this->splitThresh = splitThresh;
+    this->_justSplit = justSplit;
+    *(this->stateSpace->low) = low;
+    *(this->stateSpace->high) = high;
+    this->replaceRoot(root);
+    return true;
+}
+
+bool QTree::deserializeNode(istream& in, const string& data, vector<vector<double>*>& vectors, QTreeNode*& node,
+                            int depth) {
+    // node is set to what was built, also on failure, so that the caller can free it
+    node = nullptr;
+    uint8_t type;
+    double visits;
+    if(depth > MAX_STATE_DEPTH || !readBinary(in, type) || type > NULL_NODE) {
+        return false;
+    }
+    if(type == NULL_NODE) {
+        return true;
+    }
+    if(!readBinary(in, visits)) {
+        return false;
+    }
+
+    int numFeatures = this->stateSpace->low->size();
+    if(type == LEAF_NODE) {
+        uint64_t qsIndex, numSplits;
+        if(!readBinary(in, qsIndex) || qsIndex >= vectors.size() || !readBinary(in, numSplits)) {
+            return false;
+        }
+        const uint64_t splitBytes = sizeof(int32_t) + 3 * sizeof(double) + 2 * sizeof(uint64_t);
+        if(numSplits > remainingBytes(in, data) / splitBytes) {
+            return false;
+        }
+        vector<LeafSplit*>* splits = new vector<LeafSplit*>();
+        node = new QTreeLeaf(vectors[qsIndex], visits, splits);
+        for(uint64_t i = 0; i < numSplits; i++) {
+            int32_t feature;
+            double value, leftVisits, rightVisits;
+            uint64_t leftIndex, rightIndex;
+            if(!readBinary(in, feature) || feature < 0 || feature >= numFeatures || !readBinary(in, value) ||
+               !readBinary(in, leftIndex) || leftIndex >= vectors.size() ||
+               !readBinary(in, rightIndex) || rightIndex >= vectors.size() ||
+               !readBinary(in, leftVisits) || !readBinary(in, rightVisits)) {
+                return false;
             }
+            splits->push_back(new LeafSplit(feature, value, vectors[leftIndex], vectors[rightIndex], leftVisits,
+                                            rightVisits));
         }
+        return true;
     }
+
+    int32_t feature;
+    double value;
+    if(!readBinary(in, feature) || feature < 0 || feature >= numFeatures || !readBinary(in, value)) {
+        return false;
+    }
+    QTreeInternal* internal = new QTreeInternal(nullptr, nullptr, feature, value, visits);
+    node = internal;
+    // as saved by serializeState, internal nodes always have both children
+    return this->deserializeNode(in, data, vectors, internal->leftChild, depth + 1) && internal->leftChild != nullptr &&
+           this->deserializeNode(in, data, vectors, internal->rightChild, depth + 1) && internal->rightChild != nullptr;
 }
 
-std::vector<double> QTree::explain_useraware(int userAction, int action, std::vector<double> state, bool usingHigherNodes) {
+void QTree::infoWeightAnalysis(string path) {
+    ofstream outdata;
+    outdata.open(path);
+    for(InfoWeight info : infoWeights()) {
+        string direction = info.direction == -1.0 ? "left" : "right";
+        outdata << "feature " << info.feature << " direction " << direction << " value 1 " <<
+        info.value1 << " value 2 " << info.value2 << "\n";
+    }
+    outdata.close();
+}
 
-    // find icub_action leaf: just a tree descent
-    QTreeNode* icubAction = this->root;
-    while(! icubAction->isLeaf()) {
-        QTreeInternal* curr = dynamic_cast<QTreeInternal*>(icubAction);
-        int feature = curr->feature;
-        double value = curr->value;
+vector<InfoWeight> QTree::infoWeights() {
+    // the pairs of nodes on a same path testing the same feature in the same direction, each pair once
+    vector<InfoWeight> result;
+    int numFeatures = this->stateSpace->low->size();
+
+    // thresholds met along the current path, indexed by feature * 2 + direction (0 left, 1 right)
+    vector<vector<double>> pathValues(numFeatures * 2);
+    infoWeightsRecursive(this->root, pathValues, result);
+    return result;
+}
+
+void QTree::infoWeightsRecursive(QTreeNode* node, vector<vector<double>>& pathValues, vector<InfoWeight>& result) {
+    if(node == nullptr || node->isLeaf()) {
+        return;
+    }
+
+    QTreeInternal* curr = dynamic_cast<QTreeInternal*>(node);
+    QTreeNode* children[2] = {curr->leftChild, curr->rightChild};
+
+    for(int direction = 0; direction < 2; direction++) {
+        if(children[direction] == nullptr) {
+            continue;
+        }
+
+        // the node pairs with the ancestors met in the direction it takes, when it is the deeper node
+        int index = curr->feature * 2 + direction;
+        vector<double>& values = pathValues[index];
+        for(double value : values) {
+            InfoWeight info = {curr->feature, direction == 0 ? -1.0 : 1.0, value, curr->value};
+            result.push_back(info);
+        }
+
+        values.push_back(curr->value);
+        infoWeightsRecursive(children[direction], pathValues, result);
+        values.pop_back();
+    }
+}
+
+QTreeNode* QTree::findExplanationLeaf(std::vector<double>& state) {
+    // just a tree descent, following the same rule of the explanations
+    QTreeNode* curr = this->root;
+    while(! curr->isLeaf()) {
+        QTreeInternal* currInternal = dynamic_cast<QTreeInternal*>(curr);
 
-        QTreeNode* tmp = nullptr;
         // here I don't need to check whether curr's children are nullptr
-        if(state[feature] <= value) {
-            icubAction = curr->leftChild;
+        if(state[currInternal->feature] <= currInternal->value) {
+            curr = currInternal->leftChild;
+        }
+        else {
+            curr = currInternal->rightChild;
+        }
+    }
+    return curr;
+}
+
+Decision QTree::decide(std::vector<double> state, int explanationType, int userAction, bool usingHigherNodes) {
+    // a single descent gives both the action and the leaf the explanations start from
+    bool tie = false;
+    QTreeNode* leaf = this->root;
+    while(! leaf->isLeaf()) {
+        QTreeInternal* curr = dynamic_cast<QTreeInternal*>(leaf);
+        double stateValue = state[curr->feature];
+
+        if(stateValue == curr->value) {
+            tie = true;
+        }
+        if(stateValue <= curr->value) {
+            leaf = curr->leftChild;
         }
         else {
-            icubAction = curr->rightChild;
+            leaf = curr->rightChild;
         }
     }
 
-    // now icubAction is leaf
-    icubAction = dynamic_cast<QTreeLeaf*>(icubAction);
+    // selectA sends the ties to the right child: only in that case the action leaf differs
+    QTreeNode* actionLeaf = leaf;
+    if(tie) {
+        actionLeaf = this->root;
+        while(! actionLeaf->isLeaf()) {
+            QTreeInternal* curr = dynamic_cast<QTreeInternal*>(actionLeaf);
+            actionLeaf = state[curr->feature] < curr->value ? curr->leftChild : curr->rightChild;
+        }
+    }
+
+    QTreeLeaf* currLeaf = dynamic_cast<QTreeLeaf*>(actionLeaf);
+    Decision decision;
+    decision.qs = *(currLeaf->qs);
+    decision.action = Utils::argmax(currLeaf->qs);
+    decision.leafId = (uintptr_t) currLeaf;
+
+    if(explanationType == CLASSIC_EXPLANATION) {
+        decision.explanation = explainClassicAtLeaf(leaf, decision.action, state, usingHigherNodes);
+    }
+    else if(explanationType == USERAWARE_EXPLANATION) {
+        decision.explanation = explainUserawareAtLeaf(leaf, userAction, decision.action, state);
+    }
+
+    return decision;
+}
+
+std::vector<double> QTree::explain_useraware(int userAction, int action, std::vector<double> state, bool usingHigherNodes) {
+    return explainUserawareAtLeaf(findExplanationLeaf(state), userAction, action, state);
+}
+
+std::vector<double> QTree::explainUserawareAtLeaf(QTreeNode* leaf, int userAction, int action, std::vector<double>& state) {
+    // the contrastive explanation only depends on the fact's leaf and on the foil (the user's action)
+    ExplanationKey key = {(uintptr_t) leaf, action, userAction, false, 0};
+    ExplanationEntry entry;
+
+    if(! this->explanationCache->get(key, entry)) {
+        entry.explanation = computeExplanationUseraware(userAction, action, state);
+        entry.historyReset = false;
+        this->explanationCache->put(key, entry);
+    }
+
+    return entry.explanation;
+}
+
+std::vector<double> QTree::computeExplanationUseraware(int userAction, int action, std::vector<double>& state) {
+
+    // find icub_action leaf: just a tree descent
+    QTreeNode* icubAction = findExplanationLeaf(state);
 
     // find all the k user_action leafs
     vector<QTreeNode*> userActions = findUserActionLeafs(userAction);
@@ -584,6 +1060,29 @@ int QTree::distanceBetweenNodes(QTreeNode* ancestor, QTreeNode* node, int distan
 
 
 std::vector<double> QTree::explain_classic(int action, std::vector<double> state, bool usingHigherNodes) {
+    return explainClassicAtLeaf(findExplanationLeaf(state), action, state, usingHigherNodes);
+}
+
+std::vector<double> QTree::explainClassicAtLeaf(QTreeNode* leaf, int action, std::vector<double>& state, bool usingHigherNodes) {
+    // the path to a leaf is unique: the explanation only depends on the leaf and on what has already been explained
+    ExplanationKey key = {(uintptr_t) leaf, action, -1, usingHigherNodes, this->alreadyExplainedHash[action]};
+    ExplanationEntry entry;
+
+    if(! this->explanationCache->get(key, entry)) {
+        entry = computeExplanationClassic(action, state, usingHigherNodes);
+        this->explanationCache->put(key, entry);
+    }
+
+    // replay the side effects on the explanation history
+    if(entry.historyReset) {
+        clearAlreadyExplained(action);
+    }
+    addTupleToAlreadyExplained(action, entry.explanation[0], entry.explanation[1], entry.explanation[2]);
+
+    return entry.explanation;
+}
+
+ExplanationEntry QTree::computeExplanationClassic(int action, std::vector<double>& state, bool usingHigherNodes) {
     vector<infoNode> visited;
     QTreeNode* curr = this->root;
 
@@ -620,7 +1119,8 @@ std::vector<double> QTree::explain_classic(int action, std::vector<double> state
     //visited.erase(visited.end());
 
     // TODO: should I ensure only one explanation per feature, the most refined one?
-    visited = deleteFeaturesAlreadyExplained(action, visited);
+    bool historyReset = false;
+    visited = deleteFeaturesAlreadyExplained(action, visited, historyReset);
 
     infoNode explanationInfo = visited.front();
     QTreeInternal* explanationNode = dynamic_cast<QTreeInternal*>(explanationInfo.node);
@@ -629,9 +1129,9 @@ std::vector<double> QTree::explain_classic(int action, std::vector<double> state
     double direction = -1.0;                                    // left
     if(explanationInfo.direction == "right") direction = 1.0;   // right
 
-    vector<double> result = {feature, direction, value};
-
-    addTupleToAlreadyExplained(action, feature, direction, value);
+    ExplanationEntry result;
+    result.explanation = {feature, direction, value};
+    result.historyReset = historyReset;
 
     return result;
 }
@@ -678,7 +1178,7 @@ vector<infoNode> QTree::deleteUselessInfoNodes(vector<infoNode> visited, bool us
     return visited;
 }
 
-vector<infoNode> QTree::deleteFeaturesAlreadyExplained(int action, vector<infoNode> visited) {
+vector<infoNode> QTree::deleteFeaturesAlreadyExplained(int action, vector<infoNode> visited, bool& historyReset) {
 
     vector<infoNode> safeCopy = vector<infoNode>(visited);
     vector<tuple<int, string, double>>* currAlreadyExplained =
@@ -707,8 +1207,9 @@ vector<infoNode> QTree::deleteFeaturesAlreadyExplained(int action, vector<infoNo
 
     if(visited.empty()) {
         // when all the explanations have been given, redo from the beginning
+        // (the caller is in charge of clearing alreadyExplained[action])
         visited = safeCopy;
-        this->alreadyExplained[action].clear();
+        historyReset = true;
     }
 
     return visited;
@@ -725,6 +1226,37 @@ void QTree::addTupleToAlreadyExplained(int action, double feature, double direct
         // alreadyExplained[action] doesn't contain curr: to insert
     this->alreadyExplained[action].insert(this->alreadyExplained[action].end(), curr);
     //}
+
+    // update the history fingerprint (FNV-like, order sensitive)
+    uint64_t h = this->alreadyExplainedHash[action];
+    h = (h ^ hash<int>()((int)feature)) * 1099511628211ULL;
+    h = (h ^ hash<double>()(direction)) * 1099511628211ULL;
+    h = (h ^ hash<double>()(value)) * 1099511628211ULL;
+    this->alreadyExplainedHash[action] = h;
+}
+
+void QTree::clearAlreadyExplained(int action) {
+    this->alreadyExplained[action].clear();
+    this->alreadyExplainedHash[action] = EMPTY_HISTORY_HASH;
+}
+
+vector<double> QTree::getAlreadyExplained(int action) {
+    // flattened {feature, direction, value} of the explanations already given for action
+    vector<double> history;
+    for(auto x : this->alreadyExplained[action]) {
+        history.push_back(get<0>(x));
+        history.push_back(get<1>(x) == "left" ? -1.0 : 1.0);
+        history.push_back(get<2>(x));
+    }
+    return history;
+}
+
+void QTree::setAlreadyExplained(int action, vector<double> history) {
+    // the fingerprint is rebuilt as well, so cached explanations stay valid
+    this->clearAlreadyExplained(action);
+    for(size_t i = 0; i + 2 < history.size(); i += 3) {
+        this->addTupleToAlreadyExplained(action, history[i], history[i + 1], history[i + 2]);
+    }
 }
 
 double QTree::getAverageDepth() {
@@ -744,4 +1276,39 @@ void QTree::recursiveDepth(QTreeNode* parent, int& parentDepth, int& accumulateD
         recursiveDepth(curr->leftChild, parentDepth, accumulateDepth, nodeCount);
         recursiveDepth(curr->rightChild, parentDepth, accumulateDepth, nodeCount);
     }
-}
\ No newline at end of file
+}
+
+TreeStats QTree::treeStats() {
+    TreeStats stats;
+    stats.numNodes = 0;
+    stats.numLeaves = 0;
+    stats.featureSplits = vector<long>(this->stateSpace->low->size(), 0);
+    stats.leafActions = vector<long>(this->actionSpace->size(), 0);
+    treeStatsRecursive(this->root, 0, stats);
+    return stats;
+}
+
+void QTree::treeStatsRecursive(QTreeNode* node, int depth, TreeStats& stats) {
+    if(node == nullptr) {
+        return;
+    }
+    stats.numNodes++;
+
+    if(node->isLeaf()) {
+        QTreeLeaf* leaf = dynamic_cast<QTreeLeaf*>(node);
+        if((int) stats.depthHistogram.size() <= depth) {
+            stats.depthHistogram.resize(depth + 1, 0);
+        }
+        stats.depthHistogram[depth]++;
+        stats.numLeaves++;
+        stats.leafActions[Utils::argmax(leaf->qs)]++;
+        stats.leafVisits.push_back(leaf->visits);
+    }
+    else {
+        QTreeInternal* curr = dynamic_cast<QTreeInternal*>(node);
+        stats.featureSplits[curr->feature]++;
+        stats.internalVisits.push_back(curr->visits);
+        treeStatsRecursive(curr->leftChild, depth + 1, stats);
+        treeStatsRecursive(curr->rightChild, depth + 1, stats);
+    }
+}
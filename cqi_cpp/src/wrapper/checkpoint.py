@@ -0,0 +1,66 @@
+import os
+import pickle
+import threading
+
+
+class CheckpointWriter(object):
+    """
+    Writes training checkpoints in a background thread. The state is pickled by the caller, so that the training can go
+    on while the file is written; the file is replaced atomically, so an interrupted write never corrupts the previous
+    checkpoint. If a new checkpoint arrives while the previous one is still pending, only the newest one is written.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pending = None
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name="checkpoint-writer", daemon=True)
+        self.thread.start()
+
+    def save(self, state):
+        """
+        :param state: picklable dict with the whole training state
+        """
+        data = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.condition:
+            self.pending = data
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.closed:
+                    self.condition.wait()
+                if self.pending is None:
+                    return
+                data, self.pending = self.pending, None
+            write_atomically(self.path, data)
+
+    def close(self):
+        """
+        Waits for the pending checkpoint to be written.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+
+def write_atomically(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path):
+    """
+    :return: the state saved in path, or None if there is no checkpoint
+    """
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return pickle.load(f)
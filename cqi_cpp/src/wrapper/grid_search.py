@@ -0,0 +1,154 @@
+import argparse
+import contextlib
+import csv
+import itertools
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+HPARAMS = ["gamma", "alpha", "visit_decay", "split_thresh_max", "split_thresh_decay", "num_splits"]
+RESULTS = ["num_nodes", "avg_reward", "timesteps_per_ep", "train_seconds"]
+
+# set once per worker process, so that gym and the wrapper are imported only once
+worker_env = None
+
+
+def init_worker(env_name):
+    global worker_env
+    import gym
+    worker_env = gym.make(env_name)
+
+
+@contextlib.contextmanager
+def silenced_stdout():
+    """
+    Redirects the standard output of Python and of the C++ tree (e.g. print_structure) to os.devnull.
+    """
+    stdout_fd = os.dup(1)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        os.dup2(devnull.fileno(), 1)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            os.dup2(stdout_fd, 1)
+            os.close(stdout_fd)
+
+
+def run_configuration(config, seed, train_steps, eval_steps):
+    """
+    Trains and evaluates a QTree with the hyperparameters in config (dict), in a worker process.
+    :return: dict with config, seed and the results
+    """
+    from qtree_wrapper import PyDiscrete as Discrete
+    from qtree_wrapper import PyQTree as QTree
+    from train import Train
+    from utils import convert_to_pybox
+
+    np.random.seed(seed)
+    worker_env.seed(seed)
+    worker_env.action_space.seed(seed)
+
+    qfunc = QTree(convert_to_pybox(worker_env.observation_space), Discrete(worker_env.action_space.n), None,
+                  config["gamma"], config["alpha"], config["visit_decay"], config["split_thresh_max"],
+                  config["split_thresh_decay"], config["num_splits"])
+    t = Train(qfunc, worker_env, expl_data_filename=os.devnull)
+
+    start = time.time()
+    with silenced_stdout():
+        t.train(train_steps, lambda step: max(0.05, 1 - step / 1e5))
+        train_seconds = time.time() - start
+        results, _, avg_r_per_ep, _ = t.train(eval_steps, lambda step: 0.05, eval_only=True)
+
+    timesteps_per_ep = float(results.split("Timesteps per ep: ")[1].split("\n")[0])
+    row = dict(config)
+    row.update({"seed": seed, "num_nodes": qfunc.num_nodes(), "avg_reward": avg_r_per_ep,
+                "timesteps_per_ep": timesteps_per_ep, "train_seconds": train_seconds})
+    return row
+
+
+def grid_configurations(values):
+    """
+    :param values: dict hyperparameter -> list of values
+    :return:       list of dicts, the cartesian product of the values
+    """
+    return [dict(zip(HPARAMS, combination)) for combination in itertools.product(*[values[h] for h in HPARAMS])]
+
+
+def random_configurations(values, num_configs, rng):
+    """
+    Samples num_configs distinct configurations from the grid.
+    """
+    grid = grid_configurations(values)
+    indices = rng.choice(len(grid), size=min(num_configs, len(grid)), replace=False)
+    return [grid[i] for i in sorted(indices)]
+
+
+def configuration_key(config, seed):
+    return tuple(float(config[h]) for h in HPARAMS) + (int(seed),)
+
+
+def completed_keys(results_filename):
+    """
+    :return: keys of the (configuration, seed) already in the results table, to resume an interrupted search
+    """
+    if not os.path.exists(results_filename):
+        return set()
+    with open(results_filename, newline="") as f:
+        return {configuration_key(row, row["seed"]) for row in csv.DictReader(f)}
+
+
+def parse_values(text, cast):
+    return [cast(v) for v in text.split(",")]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Grid or random search of QTree hyperparameters over a process pool. "
+                                                 "Hyperparameters take comma-separated lists of values.")
+    parser.add_argument("--gamma", default="0.99")
+    parser.add_argument("--alpha", default="0.01")
+    parser.add_argument("--visit_decay", default="0.999")
+    parser.add_argument("--split_thresh_max", default="0.1,1,10,100")
+    parser.add_argument("--split_thresh_decay", default="0.99")
+    parser.add_argument("--num_splits", default="2,3,4,5")
+    parser.add_argument("--random", type=int, default=0, help="number of sampled configurations (0 for the full grid)")
+    parser.add_argument("--trials", type=int, default=1, help="runs per configuration, with different seeds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--steps", type=int, default=int(3e7))
+    parser.add_argument("--eval_steps", type=int, default=50000)
+    parser.add_argument("--env", default="CartPole-v0")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--results", default="grid_search_results.csv")
+    args = parser.parse_args()
+
+    values = {h: parse_values(getattr(args, h), int if h == "num_splits" else float) for h in HPARAMS}
+    rng = np.random.RandomState(args.seed)
+    configs = random_configurations(values, args.random, rng) if args.random > 0 else grid_configurations(values)
+
+    # the seed of a run only depends on the trial, so the same configuration is comparable across searches
+    runs = [(config, args.seed + trial) for config in configs for trial in range(args.trials)]
+    done = completed_keys(args.results)
+    runs = [(config, seed) for config, seed in runs if configuration_key(config, seed) not in done]
+    print(f"{len(runs)} runs to do, {len(done)} already in {args.results}")
+
+    new_file = not os.path.exists(args.results)
+    with open(args.results, "a", newline="") as f, \
+            ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=(args.env,)) as pool:
+        writer = csv.DictWriter(f, fieldnames=HPARAMS + ["seed"] + RESULTS)
+        if new_file:
+            writer.writeheader()
+        futures = [pool.submit(run_configuration, config, seed, args.steps, args.eval_steps) for config, seed in runs]
+        for future in as_completed(futures):
+            row = future.result()
+            writer.writerow(row)
+            f.flush()
+            print(", ".join(f"{k}={row[k]}" for k in HPARAMS + ["seed", "num_nodes", "avg_reward"]))
+
+    with open(args.results, newline="") as f:
+        rows = list(csv.DictReader(f))
+    if rows:
+        best = max(rows, key=lambda row: float(row["avg_reward"]))
+        print("Best:", ", ".join(f"{k}={best[k]}" for k in HPARAMS + ["seed", "avg_reward"]))
@@ -14,13 +14,14 @@ class QTree(QFunc):
                  num_splits=2):
         super().__init__(state_space, act_space)
         if root is None:
-            low = self.state_space.low
-            high = self.state_space.high
-            splits = []
-            for f in range(len(low)):
-                for i in range(num_splits):
-                    splits.append(LeafSplit(f,
-                        low[f] + (high[f] - low[f])/(num_splits+1)*(i+1), np.zeros(act_space.n), np.zeros(act_space.n), 0.5, 0.5))
+            low = np.asarray(self.state_space.low, dtype=float)
+            high = np.asarray(self.state_space.high, dtype=float)
+            features = np.repeat(np.arange(len(low)), num_splits)
+            steps = np.tile(np.arange(1, num_splits + 1), len(low))
+            values = low[features] + (high[features] - low[features])/(num_splits+1)*steps
+            splits = LeafSplits(features, values, np.zeros((len(features), act_space.n)),
+                                np.zeros((len(features), act_space.n)), np.full(len(features), 0.5),
+                                np.full(len(features), 0.5))
             self.root = QTreeLeaf(np.zeros(act_space.n), 1, splits)
         else:
             self.root = root
@@ -104,32 +105,56 @@ class QTreeNode(ABC):
     def print_structure(self, prefix_head, prefix_tail):
         pass
 
-class LeafSplit():
-    def __init__(self, feature, value, left_qs, right_qs, left_visits, right_visits):
-        self.feature = feature
-        self.value = value
+class LeafSplits():
+    """
+    The split candidates of a leaf, one row each: feature and value of the test, Q-values and visits of the two
+    sides. All the candidates are updated and scored at once.
+    """
+    def __init__(self, features, values, left_qs, right_qs, left_visits, right_visits):
+        self.features = features
+        self.values = values
         self.left_qs = left_qs
         self.right_qs = right_qs
         self.left_visits = left_visits
         self.right_visits = right_visits
 
+    def __len__(self):
+        return len(self.features)
+
     def update(self, s, a, target, params):
-        self.left_visits = self.left_visits * params.val('visit_decay')
-        self.right_visits = self.right_visits * params.val('visit_decay')
-        if s[self.feature] < self.value:
-            self.left_qs[a] = (1 - params.val('alpha')) * self.left_qs[a] + params.val('alpha') * target
-            self.left_visits = self.left_visits + (1 - params.val('visit_decay'))
-        else:
-            self.right_qs[a] = (1 - params.val('alpha')) * self.right_qs[a] + params.val('alpha') * target
-            self.right_visits = self.right_visits + (1 - params.val('visit_decay'))
+        alpha = params.val('alpha')
+        visit_decay = params.val('visit_decay')
+        left = np.asarray(s)[self.features] < self.values
+        right = ~left
+        self.left_visits *= visit_decay
+        self.right_visits *= visit_decay
+        self.left_qs[left, a] = (1 - alpha) * self.left_qs[left, a] + alpha * target
+        self.left_visits[left] += 1 - visit_decay
+        self.right_qs[right, a] = (1 - alpha) * self.right_qs[right, a] + alpha * target
+        self.right_visits[right] += 1 - visit_decay
 
     def eval_utility(self, pol_q_vals):
+        """
+        :return: utility of each candidate
+        """
         action_chosen = np.argmax(pol_q_vals)
-        left_pot_util = np.max(self.left_qs) - self.left_qs[action_chosen]
-        right_pot_util = np.max(self.right_qs) - self.right_qs[action_chosen]
+        left_pot_util = np.max(self.left_qs, axis=1) - self.left_qs[:, action_chosen]
+        right_pot_util = np.max(self.right_qs, axis=1) - self.right_qs[:, action_chosen]
 
         return left_pot_util*self.left_visits + right_pot_util*self.right_visits
 
+    def child_splits(self, index, qs, new_values):
+        """
+        :return: the candidates of a child after the split on candidate index: those on the other features, then the
+                 new ones on the split feature at new_values, all starting from the child's Q-values qs
+        """
+        others = self.features != self.features[index]
+        features = np.concatenate((self.features[others], np.full(len(new_values), self.features[index])))
+        values = np.concatenate((self.values[others], new_values))
+        n = len(features)
+        return LeafSplits(features, values, np.tile(qs, (n, 1)), np.tile(qs, (n, 1)), np.full(n, 0.5),
+                          np.full(n, 0.5))
+
 
 class QTreeLeaf(QTreeNode):
     def __init__(self, qs, visits, splits):
@@ -147,36 +172,28 @@ class QTreeLeaf(QTreeNode):
         super().update(s, a, target, params)
         self.qs[a] = (1 - params.val('alpha')) * self.qs[a] + params.val('alpha') * target
 
-        for split in self.splits:
-            split.update(s, a, target, params)
+        self.splits.update(s, a, target, params)
 
     def split(self, s, box_low, box_high, params):
-        split_index = np.argmax([sp.eval_utility(self.qs) for sp in self.splits])
-        sf_split = self.splits[split_index]
-        split_feature = sf_split.feature
-        l_splits = []
-        r_splits = []
-        for sp in self.splits:
-            if sp.feature != split_feature:
-                l_splits.append(LeafSplit(sp.feature, sp.value, sf_split.left_qs.copy(), sf_split.left_qs.copy(), 0.5, 0.5))
-                r_splits.append(LeafSplit(sp.feature, sp.value, sf_split.right_qs.copy(), sf_split.right_qs.copy(), 0.5, 0.5))
-        for i in range(params.val('num_splits')):
-            l_splits.append(LeafSplit(split_feature, box_low[split_feature] + (sf_split.value - box_low[split_feature])/(params.val('num_splits')+1)*(i+1), \
-                                      sf_split.left_qs.copy(), \
-                                      sf_split.left_qs.copy(), 0.5, 0.5))
-            r_splits.append(LeafSplit(split_feature, sf_split.value + (box_high[split_feature] - sf_split.value)/(params.val('num_splits')+1)*(i+1), \
-                                      sf_split.right_qs.copy(), \
-                                      sf_split.right_qs.copy(), 0.5, 0.5))
-        left_child = QTreeLeaf(sf_split.left_qs, sf_split.left_visits, l_splits)
-        right_child = QTreeLeaf(sf_split.right_qs, sf_split.right_visits, r_splits)
+        split_index = np.argmax(self.splits.eval_utility(self.qs))
+        split_feature = self.splits.features[split_index]
+        split_value = self.splits.values[split_index]
+        left_qs = self.splits.left_qs[split_index].copy()
+        right_qs = self.splits.right_qs[split_index].copy()
+        steps = np.arange(1, params.val('num_splits') + 1)
+        l_values = box_low[split_feature] + (split_value - box_low[split_feature])/(params.val('num_splits')+1)*steps
+        r_values = split_value + (box_high[split_feature] - split_value)/(params.val('num_splits')+1)*steps
+        l_splits = self.splits.child_splits(split_index, left_qs, l_values)
+        r_splits = self.splits.child_splits(split_index, right_qs, r_values)
+        left_child = QTreeLeaf(left_qs, self.splits.left_visits[split_index], l_splits)
+        right_child = QTreeLeaf(right_qs, self.splits.right_visits[split_index], r_splits)
         val = (box_high[split_feature] + box_low[split_feature])/2
         visits = self.visits
 
         return QTreeInternal(left_child, right_child, split_feature, val, visits)
 
     def max_split_util(self, s):
-        return self.visits * np.max([sp.eval_utility(self.qs) \
-                                     for sp in self.splits])
+        return self.visits * np.max(self.splits.eval_utility(self.qs))
 
     def num_nodes(self):
         return 1
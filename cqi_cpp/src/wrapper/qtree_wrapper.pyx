@@ -1,9 +1,19 @@
 # distutils: language = c++
-# distutils: sources = qtree_wrapper.cpp
 
 from libcpp.string cimport string
 from libcpp.unordered_map cimport unordered_map
 from libcpp.vector cimport vector
+from libc.stdint cimport uintptr_t
+
+import numpy as np
+
+# explanation types of PyQTree.decide
+NO_EXPLANATION = 0
+CLASSIC_EXPLANATION = 1
+USERAWARE_EXPLANATION = 2
+
+INFO_WEIGHT_DTYPE = np.dtype([("feature", np.int32), ("direction", np.float64), ("value1", np.float64),
+                              ("value2", np.float64)])
 
 cdef extern from "../../include/state.hpp":
     cdef cppclass State:
@@ -40,36 +50,79 @@ cdef extern from "../../include/qtreenode.hpp":
         QTreeNode(double visits)
         bint isLeaf()
         vector[double]* getQS(State*)
-        void update(State* s, Action* a, int target, unordered_map[string, double]* params)
+        void update(State* s, Action* a, double target, unordered_map[string, double]* params)
         void noVisitUpdate(unordered_map[string, double]* params)
         QTreeNode* split(State*, vector[double]*, vector[double]*, unordered_map[string, double]*)
         double maxSplitUtil(State*)
         int numNodes()
         void printStructure(string, string)
 
+cdef extern from "../../include/explcache.hpp":
+    cdef cppclass ExplanationCache:
+        size_t capacity
+        long hits
+        long misses
+
+        void setCapacity(size_t)
+        void clear()
+        size_t size()
+
 cdef extern from "../../include/qtree.hpp":
+    cdef struct InfoWeight:
+        int feature
+        double direction
+        double value1
+        double value2
+
+    cdef struct TreeStats:
+        int numNodes
+        int numLeaves
+        vector[long] depthHistogram
+        vector[long] featureSplits
+        vector[long] leafActions
+        vector[double] leafVisits
+        vector[double] internalVisits
+
+    cdef struct Decision:
+        int action
+        vector[double] qs
+        uintptr_t leafId
+        vector[double] explanation
+
     cdef cppclass QTree:
+        Box* stateSpace
+        Discrete* actionSpace
         double splitThreshMax
         double splitThreshDecay
         int numSplits 
         QTreeNode* root
         bint _justSplit
         unordered_map[string, double]* params
+        ExplanationCache* explanationCache
 
         QTree(Box*, Discrete*, QTreeNode*, double, double, double, double, double, int)
         void destroyEverything()
         int selectA(State*)
         void takeTuple(State*, Action*, double, State*, bint)
+        int takeTupleBatch(const double*, const int*, const double*, const double*, const unsigned char*, int,
+                           int) except +
         void update(State*, Action*, double, State*, bint)
         int numNodes()
         void printStructure()
         bint justSplit()
         bint saveToFile(string)
-        bint setRootFromFile(string)
+        bint setRootFromFile(string, bint)
         void infoWeightAnalysis(string)
+        vector[InfoWeight] infoWeights()
         vector[double] explain_classic(int, vector[double], bint)
         vector[double] explain_useraware(int, int, vector[double], bint)
+        Decision decide(vector[double], int, int, bint)
         double getAverageDepth()
+        string serializeState()
+        bint deserializeState(string) except +
+        vector[double] getAlreadyExplained(int)
+        void setAlreadyExplained(int, vector[double])
+        TreeStats treeStats()
 
 cdef class PyVector:
     cdef vector[double]* thisptr
@@ -126,6 +179,37 @@ cdef class PyQTree:
         return self.thisptr.selectA(s.thisptr)
     def take_tuple(self, PyState s, PyAction a, double r, PyState s2, bint done):
         return self.thisptr.takeTuple(s.thisptr, a.thisptr, r, s2.thisptr, done)
+    cdef check_state_size(self, size_t size):
+        # the C++ tree indexes the states by feature without checking their size
+        if size != self.thisptr.stateSpace.low.size():
+            raise ValueError("states have %d features instead of %d" % (size, self.thisptr.stateSpace.low.size()))
+    cdef check_action(self, int action):
+        # the explanation history is indexed by action
+        if action < 0 or action >= self.thisptr.actionSpace.size():
+            raise ValueError("action %d out of range [0, %d)" % (action, self.thisptr.actionSpace.size()))
+    def take_tuple_batch(self, s, a, r, s2, done):
+        """
+        Takes the transitions (s[i], a[i], r[i], s2[i], done[i]) in order, in a single call.
+        :param s, s2: arrays (batch size, state size)
+        :param a, r, done: arrays (batch size,)
+        :return: number of splits
+        """
+        cdef double[:, ::1] s_view = np.ascontiguousarray(s, dtype=np.float64)
+        cdef int[::1] a_view = np.ascontiguousarray(a, dtype=np.int32)
+        cdef double[::1] r_view = np.ascontiguousarray(r, dtype=np.float64)
+        cdef double[:, ::1] s2_view = np.ascontiguousarray(s2, dtype=np.float64)
+        cdef unsigned char[::1] done_view = np.ascontiguousarray(done, dtype=np.uint8)
+        cdef int n = s_view.shape[0]
+        if n == 0:
+            return 0
+        if not (a_view.shape[0] == r_view.shape[0] == s2_view.shape[0] == done_view.shape[0] == n) or \
+                s2_view.shape[1] != s_view.shape[1]:
+            raise ValueError("inconsistent batch shapes")
+        self.check_state_size(s_view.shape[1])
+        if np.min(a_view) < 0 or np.max(a_view) >= self.thisptr.actionSpace.size():
+            raise ValueError("actions out of range [0, %d)" % self.thisptr.actionSpace.size())
+        return self.thisptr.takeTupleBatch(&s_view[0, 0], &a_view[0], &r_view[0], &s2_view[0, 0], &done_view[0], n,
+                                           s_view.shape[1])
     def update(self, PyState s, PyAction a, double r, PyState s2, bint done):
         return self.thisptr.update(s.thisptr, a.thisptr, r, s2.thisptr, done)
     def num_nodes(self):
@@ -136,13 +220,120 @@ cdef class PyQTree:
         return self.thisptr.justSplit()
     def save_to_file(self, string path):
         return self.thisptr.saveToFile(path)
-    def set_root_from_file(self, string path):
-        return self.thisptr.setRootFromFile(path)
+    def set_root_from_file(self, string path, bint load_params=False):
+        """
+        Loads the tree saved by save_to_file, with its split candidates and state space bounds.
+        :param load_params: if True, the training parameters saved in the file (gamma, alpha, visit decay, number of
+                            splits and split threshold) replace the ones given to the constructor, to continue the
+                            saved training as it was
+        """
+        return self.thisptr.setRootFromFile(path, load_params)
+    def get_state(self):
+        """
+        :return: bytes with the whole training state: nodes, LeafSplit statistics, split threshold and parameters
+        """
+        return self.thisptr.serializeState()
+    def set_state(self, string state):
+        """
+        Restores a get_state(), so that training continues exactly from there.
+        """
+        if not self.thisptr.deserializeState(state):
+            raise ValueError("invalid QTree state")
     def info_weight_analysis(self, string path):
         return self.thisptr.infoWeightAnalysis(path)
+    def info_weights(self):
+        """
+        :return: INFO_WEIGHT_DTYPE array with the pairs of nodes on a same path which test the same feature in the
+                 same direction (value1 is the higher node), each pair once.
+        """
+        cdef vector[InfoWeight] infos = self.thisptr.infoWeights()
+        cdef size_t n = infos.size()
+        cdef size_t i
+        features = np.empty(n, dtype=np.int32)
+        values = np.empty((3, n), dtype=np.float64)
+        cdef int[:] features_view = features
+        cdef double[:, :] values_view = values
+        for i in range(n):
+            features_view[i] = infos[i].feature
+            values_view[0, i] = infos[i].direction
+            values_view[1, i] = infos[i].value1
+            values_view[2, i] = infos[i].value2
+
+        result = np.empty(n, dtype=INFO_WEIGHT_DTYPE)
+        result["feature"] = features
+        result["direction"] = values[0]
+        result["value1"] = values[1]
+        result["value2"] = values[2]
+        return result
     def explain_classic(self, int action, vector[double] state, bint usingHigherNodes):
+        self.check_state_size(state.size())
+        self.check_action(action)
         return self.thisptr.explain_classic(action, state, usingHigherNodes)
     def explain_useraware(self, int user_action, int action, vector[double] state, bint usingHigherNodes):
+        self.check_state_size(state.size())
+        self.check_action(action)
         return self.thisptr.explain_useraware(user_action, action, state, usingHigherNodes)
+    def decide(self, vector[double] state, int explanation_type=NO_EXPLANATION, int user_action=-1, \
+        bint using_higher_nodes=True):
+        """
+        Select the action and, if requested, explain it with a single tree descent.
+        :return: action, Q-values of the leaf, leaf id, explanation (None if explanation_type is NO_EXPLANATION)
+        """
+        self.check_state_size(state.size())
+        cdef Decision decision = self.thisptr.decide(state, explanation_type, user_action, using_higher_nodes)
+        explanation = decision.explanation if decision.explanation.size() > 0 else None
+        return decision.action, decision.qs, decision.leafId, explanation
+    def decide_batch(self, states):
+        """
+        Selects the actions of many states in a single call, e.g. for the requests of several users.
+        :param states: array (n, state size)
+        :return: actions (n,), Q-values of the leaves (n, number of actions)
+        """
+        cdef double[:, ::1] states_view = np.ascontiguousarray(states, dtype=np.float64)
+        cdef Py_ssize_t n = states_view.shape[0]
+        cdef Py_ssize_t i
+        cdef vector[double] state
+        cdef Decision decision
+        self.check_state_size(states_view.shape[1])
+        actions = np.empty(n, dtype=np.int32)
+        qs = []
+        for i in range(n):
+            state.assign(&states_view[i, 0], &states_view[i, 0] + states_view.shape[1])
+            decision = self.thisptr.decide(state, NO_EXPLANATION, -1, True)
+            actions[i] = decision.action
+            qs.append(decision.qs)
+        return actions, np.array(qs, dtype=np.float64).reshape(n, -1)
     def get_average_depth(self):
         return self.thisptr.getAverageDepth()
+    def explanation_cache_stats(self):
+        return {"hits": self.thisptr.explanationCache.hits, "misses": self.thisptr.explanationCache.misses,
+                "size": self.thisptr.explanationCache.size(), "capacity": self.thisptr.explanationCache.capacity}
+    def clear_explanation_cache(self):
+        self.thisptr.explanationCache.clear()
+    def set_explanation_cache_capacity(self, size_t capacity):
+        self.thisptr.explanationCache.setCapacity(capacity)
+    def explanation_history(self):
+        """
+        :return: for each action, the flattened (feature, direction, value) explanations already given
+        """
+        return [self.thisptr.getAlreadyExplained(action) for action in range(12)]
+    def set_explanation_history(self, history):
+        """
+        Restores an explanation_history(), e.g. to explain with the same tree to several users.
+        """
+        for action in range(12):
+            self.thisptr.setAlreadyExplained(action, history[action])
+    def tree_stats(self):
+        """
+        Statistics of the whole tree, collected with a single traversal.
+        """
+        cdef TreeStats stats = self.thisptr.treeStats()
+        return {
+            "num_nodes": stats.numNodes,
+            "num_leaves": stats.numLeaves,
+            "depth_histogram": np.array(stats.depthHistogram, dtype=np.int64),
+            "feature_splits": np.array(stats.featureSplits, dtype=np.int64),
+            "leaf_actions": np.array(stats.leafActions, dtype=np.int64),
+            "leaf_visits": np.array(stats.leafVisits, dtype=np.float64),
+            "internal_visits": np.array(stats.internalVisits, dtype=np.float64)
+        }
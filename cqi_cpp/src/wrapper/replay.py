@@ -0,0 +1,59 @@
+import numpy as np
+
+
+class ReplayBuffer(object):
+    """
+    Experience replay stored in contiguous arrays, ready for PyQTree.take_tuple_batch. When full, the oldest
+    transitions are overwritten.
+    """
+
+    def __init__(self, capacity, state_size):
+        self.capacity = capacity
+        self.s = np.zeros((capacity, state_size), dtype=np.float64)
+        self.a = np.zeros(capacity, dtype=np.int32)
+        self.r = np.zeros(capacity, dtype=np.float64)
+        self.s2 = np.zeros((capacity, state_size), dtype=np.float64)
+        self.done = np.zeros(capacity, dtype=np.uint8)
+        self.position = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, s, a, r, s2, done):
+        i = self.position
+        self.s[i] = s
+        self.a[i] = a
+        self.r[i] = r
+        self.s2[i] = s2
+        self.done[i] = done
+        self.position = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def add_batch(self, s, a, r, s2, done):
+        """
+        Adds many transitions at once, e.g. the ones of a logged session.
+        :param s, s2: arrays (n, state size)
+        :param a, r, done: arrays (n,)
+        """
+        n = len(a)
+        if n > self.capacity:
+            s, a, r, s2, done = s[-self.capacity:], a[-self.capacity:], r[-self.capacity:], s2[-self.capacity:], \
+                                done[-self.capacity:]
+            self.position = (self.position + n - self.capacity) % self.capacity
+            n = self.capacity
+        indices = (self.position + np.arange(n)) % self.capacity
+        self.s[indices] = s
+        self.a[indices] = a
+        self.r[indices] = r
+        self.s2[indices] = s2
+        self.done[indices] = done
+        self.position = (self.position + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+
+    def sample(self, batch_size, rng=np.random):
+        """
+        :return: (s, a, r, s2, done) of batch_size transitions drawn uniformly, with replacement
+        """
+        indices = rng.randint(0, self.size, size=batch_size)
+        return self.s[indices], self.a[indices], self.r[indices], self.s2[indices], self.done[indices]
@@ -0,0 +1,103 @@
+import csv
+import os
+import time
+from collections import deque
+
+import numpy as np
+
+METRICS_DTYPE = np.dtype([("step", np.int64), ("seconds", np.float64), ("steps_per_sec", np.float64),
+                          ("episodes", np.int64), ("splits", np.int64), ("num_nodes", np.int64),
+                          ("epsilon", np.float64), ("last_reward", np.float64), ("reward_avg", np.float64)])
+
+
+class TrainingMetrics(object):
+    """
+    Telemetry of a training run, passed to Train.train: every record_every steps a row of METRICS_DTYPE is added to a
+    ring buffer of the last capacity rows, and every flush_every rows the buffer is written to filename (.npz: the whole
+    buffer, one array per field; .csv: the rows added since the last flush).
+    Only counters are updated at each step; the tree is not traversed, its size is tracked from the splits.
+    """
+
+    def __init__(self, filename=None, record_every=1000, flush_every=10, capacity=10000, reward_window=100):
+        self.filename = filename
+        self.record_every = record_every
+        self.flush_every = flush_every
+        self.rows = np.zeros(capacity, dtype=METRICS_DTYPE)
+        self.num_rows = 0
+        self.flushed_rows = 0
+        self.rewards = deque(maxlen=reward_window)
+
+        self.episodes = 0
+        self.splits = 0
+        self.num_nodes = 0
+        self.start_time = None
+        self.last_step = 0
+        self.last_time = None
+
+        if filename is not None and filename.endswith(".csv"):
+            with open(filename, "w", newline="") as f:
+                csv.writer(f).writerow(METRICS_DTYPE.names)
+
+    def start(self, step, num_nodes):
+        """
+        Called by Train.train before the first step.
+        """
+        self.num_nodes = num_nodes
+        self.last_step = step
+        self.start_time = self.last_time = time.perf_counter()
+
+    def on_episode(self, reward):
+        self.episodes += 1
+        self.rewards.append(reward)
+
+    def on_split(self):
+        self.splits += 1
+        self.num_nodes += 2
+
+    def record(self, step, epsilon):
+        """
+        Adds a row with the metrics at step; steps_per_sec is measured since the previous row.
+        """
+        now = time.perf_counter()
+        steps_per_sec = (step - self.last_step) / (now - self.last_time) if now > self.last_time else 0.
+        self.last_step, self.last_time = step, now
+
+        last_reward = self.rewards[-1] if self.rewards else np.nan
+        reward_avg = sum(self.rewards) / len(self.rewards) if self.rewards else np.nan
+        self.rows[self.num_rows % len(self.rows)] = (step, now - self.start_time, steps_per_sec, self.episodes,
+                                                     self.splits, self.num_nodes, epsilon, last_reward, reward_avg)
+        self.num_rows += 1
+        if self.filename is not None and self.num_rows % self.flush_every == 0:
+            self.flush()
+
+    def history(self):
+        """
+        :return: METRICS_DTYPE array with the rows still in the buffer, oldest first
+        """
+        if self.num_rows <= len(self.rows):
+            return self.rows[:self.num_rows].copy()
+        start = self.num_rows % len(self.rows)
+        return np.concatenate((self.rows[start:], self.rows[:start]))
+
+    def flush(self):
+        if self.filename.endswith(".csv"):
+            # rows overwritten before being flushed are lost
+            first = max(self.flushed_rows, self.num_rows - len(self.rows))
+            rows = self.history()[first - self.num_rows:] if first < self.num_rows else []
+            with open(self.filename, "a", newline="") as f:
+                csv.writer(f).writerows(row.tolist() for row in rows)
+        else:
+            history = self.history()
+            tmp_filename = self.filename + ".tmp.npz"
+            np.savez(tmp_filename, **{name: history[name] for name in METRICS_DTYPE.names})
+            os.replace(tmp_filename, self.filename)
+        self.flushed_rows = self.num_rows
+
+    def close(self, step, epsilon):
+        """
+        Records the last step and writes what has not been written yet.
+        """
+        if self.num_rows == 0 or self.rows[(self.num_rows - 1) % len(self.rows)]["step"] != step:
+            self.record(step, epsilon)
+        if self.filename is not None and self.flushed_rows < self.num_rows:
+            self.flush()
@@ -1,10 +1,10 @@
 import numpy as np
-import os
-import pickle
 
 from collections import defaultdict
 
 from utils import convert_to_pystate
+from checkpoint import CheckpointWriter, load_checkpoint
+from tree_history import TreeHistoryWriter
 
 from qtree_wrapper import PyAction
 
@@ -27,7 +27,7 @@ class Train(object):
         self.env = gym_env
         self.expl_data_filename = expl_data_filename
         self._self_tree_ct = 0
-        self._pickle_filename = "qfunc_copy_%d.pkl"
+        self._hist_filename = "qfunc_copy_%d.bin"
 
     def note_expla_data(self, tag, nodes, reward):
         with open(self.expl_data_filename, "a") as myfile:
@@ -36,7 +36,21 @@ class Train(object):
     def train(self, num_steps, eps_func, verbose=False, eval_only=False, penalty_check=lambda s, r: 0,
               track_data_per=0, run_tag="?", qfunc_hist=None, qfunc_hist_directory=None,
               qfunc_hist_per_every_nn=1,
-              while_watch=False):
+              while_watch=False, checkpoint_path=None, checkpoint_every=100000, metrics=None,
+              replay=None, replay_batch_size=32, replay_every=1):
+        """
+        :param qfunc_hist_directory: if not None, the tree is written there after each split (every
+                                     qfunc_hist_per_every_nn nodes once it has 10 nodes), in the format of get_state(),
+                                     by a background thread; read them back with tree_history.load_tree_history
+        :param checkpoint_path:  if not None, the training state is saved there every checkpoint_every steps (and at the
+                                 end); if a checkpoint is already there, the training resumes exactly from it
+                                 (self.env is replaced by the checkpoint's one). Trees in qfunc_hist are not saved.
+        :param metrics:          if not None, a telemetry.TrainingMetrics collecting steps/sec, episodes, splits, tree
+                                 size, epsilon and rewards
+        :param replay:           if not None, a replay.ReplayBuffer: every transition is added to it, and every
+                                 replay_every steps a minibatch of replay_batch_size transitions is sampled from it and
+                                 taken by the tree with take_tuple_batch (it is saved in the checkpoints)
+        """
         if eval_only:
             print("DEbUG DEbuG EVAL ONLY")
             self.qfunc.print_structure()
@@ -51,8 +65,51 @@ class Train(object):
         last_step_ep = -1
         single_change_features = None
         istates, fstates = None, None
-        for step in range(num_steps):
+        s = None
+        start_step = 0
+
+        checkpoint = load_checkpoint(checkpoint_path)
+        if checkpoint is not None:
+            start_step = checkpoint["step"]
+            self.qfunc.set_state(checkpoint["qfunc"])
+            self.env = checkpoint["env"]
+            np.random.set_state(checkpoint["np_random"])
+            self._self_tree_ct = checkpoint["tree_ct"]
+            if replay is not None:
+                replay = checkpoint["replay"]
+            (hist, ep_r, done, sct, r_per_ep, pen_per_ep, ts_per_ep, num_eps, last_step_ep, single_change_features,
+             istates, fstates, s) = checkpoint["loop"]
+            if verbose:
+                print(f"Resuming from step {start_step}")
+        checkpoint_writer = CheckpointWriter(checkpoint_path) if checkpoint_path is not None else None
+        hist_writer = None
+        if qfunc_hist_directory is not None and not eval_only:
+            hist_writer = TreeHistoryWriter(qfunc_hist_directory, self._hist_filename)
+            # a split replaces a leaf with an internal node and two leaves: no need to count the nodes at every split
+            tree_num_nodes = self.qfunc.num_nodes()
+        if metrics is not None:
+            metrics.start(start_step, self.qfunc.num_nodes())
+
+        def save_checkpoint(step):
+            checkpoint_writer.save({
+                "step": step,
+                "qfunc": self.qfunc.get_state(),
+                "env": self.env,
+                "np_random": np.random.get_state(),
+                "tree_ct": self._self_tree_ct,
+                "replay": replay,
+                "loop": (hist, ep_r, done, sct, r_per_ep, pen_per_ep, ts_per_ep, num_eps, last_step_ep,
+                         single_change_features, istates, fstates, s)
+            })
+
+        for step in range(start_step, num_steps):
+            if checkpoint_writer is not None and step > start_step and step % checkpoint_every == 0:
+                save_checkpoint(step)
+            if metrics is not None and step % metrics.record_every == 0:
+                metrics.record(step, eps_func(step))
             if done:
+                if metrics is not None and step > 0:
+                    metrics.on_episode(ep_r)
                 if verbose:
                     print(f"Episode reward: {ep_r}; Elapsed steps: {step}")
                     if while_watch and step > 0:
@@ -87,30 +144,36 @@ class Train(object):
             if np.random.random() < eps_func(step):
                 a = self.env.action_space.sample()
             else:
-                s = convert_to_pystate(s)
-                a = self.qfunc.select_a(s)
+                a = self.qfunc.select_a(convert_to_pystate(s))
             s2, r, done, _ = self.env.step(a)
             if while_watch:
                 sct.new_states(s2)
             if not eval_only:
-                s, s2 = convert_to_pystate(s), convert_to_pystate(s2)
-                a = PyAction(a)
-
-                self.qfunc.take_tuple(s, a, r, s2, done)
+                self.qfunc.take_tuple(convert_to_pystate(s), PyAction(a), r, convert_to_pystate(s2), done)
                 if qfunc_hist is not None and self.qfunc.just_split():
                     qfunc_hist.append(self.qfunc.get_pre_split())
-                if qfunc_hist_directory is not None and self.qfunc.just_split():
-                    tree_pre_split = self.qfunc.get_pre_split()
-                    nn = tree_pre_split.num_nodes()
-                    if nn < 10 or nn % qfunc_hist_per_every_nn == 0:
+                num_splits = int(self.qfunc.just_split())
+                if replay is not None:
+                    replay.add(s, a, r, s2, done)
+                    if len(replay) >= replay_batch_size and step % replay_every == 0:
+                        num_splits += self.qfunc.take_tuple_batch(*replay.sample(replay_batch_size))
+                if metrics is not None:
+                    for _ in range(num_splits):
+                        metrics.on_split()
+                if hist_writer is not None and num_splits > 0:
+                    tree_num_nodes += 2 * num_splits
+                    if tree_num_nodes < 10 or tree_num_nodes % qfunc_hist_per_every_nn == 0:
                         self._self_tree_ct = self._self_tree_ct + 1
-                        with open(os.path.join(qfunc_hist_directory, (self._pickle_filename % self._self_tree_ct)), 'wb') as pfile:
-                            sf = tree_pre_split.sfuncs
-                            tree_pre_split.sfuncs = None
-                            pickle.dump(tree_pre_split, pfile)
-                            tree_pre_split.sfuncs = sf
+                        hist_writer.save(self._self_tree_ct, self.qfunc.get_state())
             s = s2
             ep_r += r
+        if checkpoint_writer is not None:
+            save_checkpoint(num_steps)
+            checkpoint_writer.close()
+        if hist_writer is not None:
+            hist_writer.close()
+        if metrics is not None:
+            metrics.close(num_steps, eps_func(num_steps))
         if eval_only:
             avg_r_per_ep = np.mean(r_per_ep)
             results = f"Num_eps: {num_eps}\nReward per ep: {avg_r_per_ep}\nTimesteps per ep: {np.mean(ts_per_ep)}\nPenalties per ep: {np.mean(pen_per_ep)}"
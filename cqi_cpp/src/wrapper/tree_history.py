@@ -0,0 +1,61 @@
+import os
+import queue
+import re
+import threading
+
+from checkpoint import write_atomically
+
+
+class TreeHistoryWriter(object):
+    """
+    Writes the trees recorded during the training in a background thread, in the compact format of
+    PyQTree.get_state(), one file per tree. The queue is bounded: if the disk falls behind, the training waits instead
+    of filling the memory with snapshots.
+    """
+
+    def __init__(self, directory, filename="qfunc_copy_%d.bin", max_pending=16):
+        self.directory = directory
+        self.filename = filename
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self.run, name="tree-history-writer", daemon=True)
+        self.thread.start()
+
+    def save(self, tree_ct, state):
+        """
+        :param tree_ct: number of the tree in the history
+        :param state:   bytes returned by PyQTree.get_state()
+        """
+        self.queue.put((tree_ct, state))
+
+    def run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            tree_ct, state = task
+            write_atomically(os.path.join(self.directory, self.filename % tree_ct), state)
+
+    def close(self):
+        """
+        Waits for the queued trees to be written.
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+
+def load_tree_history(directory, filename="qfunc_copy_%d.bin"):
+    """
+    :return: list of the states written by a TreeHistoryWriter, in training order; each one can be restored with
+             PyQTree.set_state()
+    """
+    pattern = re.compile(re.escape(filename).replace("%d", r"(\d+)") + "$")
+    files = []
+    for name in os.listdir(directory):
+        match = pattern.match(name)
+        if match:
+            files.append((int(match.group(1)), name))
+    states = []
+    for _, name in sorted(files):
+        with open(os.path.join(directory, name), "rb") as f:
+            states.append(f.read())
+    return states
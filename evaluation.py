@@ -0,0 +1,118 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from model import QTree, Discrete, convert_to_pybox, convert_to_pystate
+from NuclearPowerPlant import NuclearPowerPlant
+
+ANOMALY_TYPES = ["temperature", "pressure", "water_high", "water_low"]
+
+# trees loaded by a worker process, by filename: each one is read once per worker
+worker_trees = {}
+
+
+def load_tree(tree_filename):
+    if tree_filename not in worker_trees:
+        env = NuclearPowerPlant()
+        DT = QTree(convert_to_pybox(env.observation_space), Discrete(env.action_space.n), None, gamma=0.8,
+                   alpha=0.01, visit_decay=0.999, split_thresh_max=1000000, split_thresh_decay=0.99, num_splits=3)
+        DT.set_root_from_file(tree_filename.encode())
+        worker_trees[tree_filename] = DT
+    return worker_trees[tree_filename]
+
+
+def check_tree_file(tree_filename):
+    """
+    Raises ValueError if some internal node of the tree has a missing child: the policy would crash on reaching it.
+    """
+    with open(tree_filename) as f:
+        missing = [line_number for line_number, line in enumerate(f, 1) if line.startswith("internal") and
+                   ("hasLeftChild 0" in line or "hasRightChild 0" in line)]
+    if missing:
+        raise ValueError("%s: internal nodes without a child at lines %s" % (tree_filename, missing))
+
+
+def anomaly_types(env):
+    """
+    :return: bool array, which of ANOMALY_TYPES are in the env's current state
+    """
+    return np.array([env.temperature_water_core > env.temperature_water_core_boundaries.max(),
+                     env.pressure_core > env.pressure_core_boundaries.max(),
+                     env.level_water_steam_generator > env.level_water_steam_generator_boundaries.max(),
+                     env.level_water_steam_generator < env.level_water_steam_generator_boundaries.min()])
+
+
+def evaluate_seed(tree_filename, seed, num_episodes, max_episode_steps, epsilon):
+    """
+    Runs num_episodes episodes of the tree's greedy policy, with epsilon random actions drawn from seed. An episode
+    ends at the first anomaly or after max_episode_steps steps.
+    :return: dict of arrays with one row per episode: reward, length, energy (total), anomalies (num_episodes,
+             len(ANOMALY_TYPES)) with the anomalies which ended the episode
+    """
+    DT = load_tree(tree_filename)
+    rng = np.random.RandomState(seed)
+    env = NuclearPowerPlant()
+    results = {"reward": np.zeros(num_episodes), "length": np.zeros(num_episodes, dtype=int),
+               "energy": np.zeros(num_episodes), "anomalies": np.zeros((num_episodes, len(ANOMALY_TYPES)), dtype=bool)}
+
+    for episode in range(num_episodes):
+        obs = env.reset()
+        for step in range(max_episode_steps):
+            if rng.random_sample() < epsilon:
+                action = rng.randint(env.action_space.n)
+            else:
+                action = DT.select_a(convert_to_pystate(obs))
+            obs, r, anomaly, info = env.step(int(action))
+            results["reward"][episode] += r
+            results["energy"][episode] += info["energy"]
+            results["length"][episode] = step + 1
+            if anomaly:
+                results["anomalies"][episode] = anomaly_types(env)
+                break
+    return results
+
+
+def evaluate(tree_filenames, seeds, num_episodes=10, max_episode_steps=200, epsilon=0.05, workers=None):
+    """
+    Evaluates each tree with each seed, in parallel processes.
+    :return: dict tree filename -> dict of arrays as in evaluate_seed, with an additional first axis for the seeds
+    """
+    for tree_filename in tree_filenames:
+        check_tree_file(tree_filename)
+    with ProcessPoolExecutor(workers) as pool:
+        futures = {(tree_filename, seed): pool.submit(evaluate_seed, tree_filename, seed, num_episodes,
+                                                      max_episode_steps, epsilon)
+                   for tree_filename in tree_filenames for seed in seeds}
+        results = {}
+        for tree_filename in tree_filenames:
+            per_seed = [futures[(tree_filename, seed)].result() for seed in seeds]
+            results[tree_filename] = {key: np.stack([r[key] for r in per_seed]) for key in per_seed[0]}
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Evaluate DTs over many seeds in parallel processes.")
+    parser.add_argument("trees", nargs="+", help="tree files, e.g. models/DT.txt models/winner_DT.txt")
+    parser.add_argument("--seeds", type=int, default=16)
+    parser.add_argument("--episodes", type=int, default=10, help="per seed")
+    parser.add_argument("--max-episode-steps", type=int, default=200)
+    parser.add_argument("--epsilon", type=float, default=0.05)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--output", default=None, help="npz file with all the arrays")
+    args = parser.parse_args()
+
+    results = evaluate(args.trees, range(args.seeds), args.episodes, args.max_episode_steps, args.epsilon,
+                       args.workers)
+
+    print("tree,reward_mean,reward_std,length_mean,energy_mean," + ",".join(ANOMALY_TYPES))
+    for tree_filename, r in results.items():
+        anomalies = r["anomalies"].reshape(-1, len(ANOMALY_TYPES)).sum(axis=0)
+        print("%s,%.3f,%.3f,%.1f,%.3f,%s" % (tree_filename, r["reward"].mean(), r["reward"].std(), r["length"].mean(),
+                                             r["energy"].mean(), ",".join(str(n) for n in anomalies)))
+
+    if args.output is not None:
+        np.savez(args.output, anomaly_types=ANOMALY_TYPES,
+                 **{"%d_%s" % (i, key): value for i, tree_filename in enumerate(args.trees)
+                    for key, value in results[tree_filename].items()})
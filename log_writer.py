@@ -0,0 +1,120 @@
+import atexit
+import csv
+import queue
+import threading
+
+
+class CSVLog:
+    """
+    A CSV file written by a LogWriter: writerow() only enqueues the row.
+    """
+
+    def __init__(self, log_writer, filename, header=None):
+        self.log_writer = log_writer
+        self.filename = filename
+        self.file = open(filename, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        if header is not None:
+            self.writerow(header)
+
+    def writerow(self, row):
+        self.log_writer.submit(self.writer.writerow, row)
+
+
+class LogWriter:
+    """
+    Background thread which performs the logging in place of the caller: rows and logging calls are queued and executed
+    in the same order, and the files are flushed once per batch instead of once per row.
+    The queue is bounded: if the thread falls behind, the callers wait instead of filling the memory. No call is dropped.
+    """
+
+    def __init__(self, max_queue_size=10000, max_batch_size=256):
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.max_batch_size = max_batch_size
+        self.logs = []
+        self.closed = False
+        # callers between the check of closed and the end of their put, which close() waits for
+        self.no_submitting = 0
+        self.condition = threading.Condition()
+
+        self.thread = threading.Thread(target=self.run, name="log-writer", daemon=True)
+        self.thread.start()
+
+    def open(self, filename, header=None):
+        """
+        :return: a CSVLog writing to filename through this writer
+        """
+        log = CSVLog(self, filename, header)
+        self.logs.append(log)
+        return log
+
+    def submit(self, function, *args):
+        """
+        Queues function(*args) to be executed by the writer's thread, waiting if the queue is full.
+        Once the writer is closed, the call is executed in place, after everything queued before it.
+        """
+        with self.condition:
+            closed = self.closed
+            if not closed:
+                self.no_submitting += 1
+        if closed:
+            self.thread.join()
+            function(*args)
+            return
+
+        # the put is done without holding the lock, so that a caller waiting for room does not block the others
+        try:
+            self.queue.put((function, args))
+        finally:
+            with self.condition:
+                self.no_submitting -= 1
+                self.condition.notify_all()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            for task in batch:
+                if task is None:
+                    self.flush_files()
+                    return
+                function, args = task
+                try:
+                    function(*args)
+                except Exception as e:
+                    print("LOG WRITER ERROR:", e)
+            self.flush_files()
+
+    def flush_files(self):
+        for log in self.logs:
+            log.file.flush()
+
+    def close(self):
+        """
+        Writes everything still queued, then closes the files. Called at exit for the shared writer.
+        """
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.wait_for(lambda: self.no_submitting == 0)
+        self.queue.put(None)
+        self.thread.join()
+        for log in self.logs:
+            log.file.close()
+
+
+shared_log_writer = None
+
+
+def get_log_writer():
+    """
+    :return: the writer shared by the whole application, created at the first call.
+    """
+    global shared_log_writer
+    if shared_log_writer is None:
+        shared_log_writer = LogWriter()
+        atexit.register(shared_log_writer.close)
+    return shared_log_writer
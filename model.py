@@ -1,7 +1,9 @@
 import pyximport
 pyximport.install()
 
+import atexit
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import time
 
@@ -11,6 +13,8 @@ from cqi_cpp.src.wrapper.qtree_wrapper import PyQTree as QTree
 from cqi_cpp.src.wrapper.qtree_wrapper import PyVector as Vector
 from cqi_cpp.src.wrapper.qtree_wrapper import PyState as State
 from cqi_cpp.src.wrapper.qtree_wrapper import PyAction as Action
+from cqi_cpp.src.wrapper.qtree_wrapper import CLASSIC_EXPLANATION, USERAWARE_EXPLANATION
+from cqi_cpp.src.wrapper.checkpoint import CheckpointWriter, load_checkpoint
 
 from NuclearPowerPlant import NuclearPowerPlant
 from partner_model import PartnerModel
@@ -50,95 +54,117 @@ def convert_to_pystate(s):
     return State(v)
 
 
-def verbalise_explanation(feature, direction, value):
+FEATURES_NAMES = {
+    0: "temperature of the water in the core",
+    1: "pressure of the core",
+    2: "level of water in the steam generator",
+    3: "power of the reactor",
+    4: "security rods",
+    5: "sustain rods",
+    6: "fuel rods",
+    7: "regulatory rods"
+}
+
+UNIT_MEASURES = {
+    0: " degrees",
+    1: " atmospheres",
+    2: " cubic meters",
+    3: " megawat"
+}
+
+ACTION_SUBJECT_NAMES = {
+    0: 'skip',
+    1: 'security rods',
+    2: 'security rods',
+    3: 'sustain rods',
+    4: 'sustain rods',
+    5: 'sustain rods',
+    6: 'fuel rods',
+    7: 'fuel rods',
+    8: 'regulatory rods',
+    9: 'regulatory rods',
+    10: 'regulatory rods',
+    11: 'water in the steam generator'
+}
+
+
+class VerbalisationTable(object):
+    """
+    Phrases for the DT's suggestions and explanations, built once: at query time only the threshold value is
+    formatted.
+    """
+
+    def __init__(self, no_actions=12, no_features=8):
+        self.suggestions = [self.build_suggestion(action) for action in range(no_actions)]
+        self.explanations = {}
+        for feature in range(no_features):
+            for direction in (-1.0, 1.0):
+                self.explanations[(feature, direction)] = self.build_explanation(feature, direction)
+
+    @staticmethod
+    def build_suggestion(action):
+        ending = ""
+        if action == 0:
+            phrase = "I would "
+        elif 0 < action < 11:
+            phrase = "I would set "
+            if action == 1 or action == 3 or action == 6 or action == 8:
+                ending = " up the "
+            elif action == 2 or action == 5 or action == 7 or action == 10:
+                ending = " down the "
+            elif action == 4 or action == 9:
+                ending = " middle the "
+        elif action == 11:
+            phrase = "I would add "
+        return phrase + ACTION_SUBJECT_NAMES[action] + ending
+
+    @staticmethod
+    def build_explanation(feature, direction):
+        """
+        :return: (prefix, suffix) for continuous features, the value goes in between;
+                 a tuple of (upper bound, phrase) for the rods, the value selects the phrase.
+        """
+        starting = "Because the " + FEATURES_NAMES[feature]
+
+        if feature < 4:
+            direction_string = " is minor or equal than " if direction == -1.0 else " is greater than "
+            return starting + direction_string, UNIT_MEASURES[feature]
 
-    features_names = {
-        0: "temperature of the water in the core",
-        1: "pressure of the core",
-        2: "level of water in the steam generator",
-        3: "power of the reactor",
-        4: "security rods",
-        5: "sustain rods",
-        6: "fuel rods",
-        7: "regulatory rods"
-    }
-
-    unit_measure = ""
-
-    if feature < 4:
-        direction_string = " is minor or equal " if direction == -1.0 else " is greater "
-        value = int(value)
-
-        if feature == 0:
-            direction_string += "than "
-            unit_measure = " degrees"
-        elif feature == 1:
-            direction_string += "than "
-            unit_measure = " atmospheres"
-        elif feature == 2:
-            direction_string += "than "
-            unit_measure = " cubic meters"
-        elif feature == 3:
-            direction_string += "than "
-            unit_measure = " megawat"
-
-    else:
-        direction_string = " are "
         if feature == 5 or feature == 7:
-            if value <= 0.5:
-                value = "up"
-            elif value <= 1.5:
-                direction_string += "a "
-                value = "middle"
-            else:
-                value = "down"
-        elif feature == 4 or feature == 6:
-            if value <= 0.5:
-                value = "up"
-            else:
-                value = "down"
+            return (0.5, starting + " are up"), (1.5, starting + " are a middle"), (np.inf, starting + " are down")
+        return (0.5, starting + " are up"), (np.inf, starting + " are down")
+
+    def suggestion(self, action):
+        return self.suggestions[action]
+
+    def explanation(self, feature, direction, value):
+        feature = int(feature)
+        direction = -1.0 if direction == -1.0 else 1.0
+        entry = self.explanations[(feature, direction)]
+
+        if feature < 4:
+            return entry[0] + str(int(value)) + entry[1]
+        for bound, phrase in entry:
+            if value <= bound:
+                return phrase
+
+
+_verbalisation_table = None
+
 
-    starting = "Because the "
-    if feature == 2:
-        starting = "Because the "
-    elif feature in [4, 5, 6, 7]:
-        starting = "Because the "
+def get_verbalisation_table():
+    global _verbalisation_table
+    if _verbalisation_table is None:
+        _verbalisation_table = VerbalisationTable()
+    return _verbalisation_table
 
-    return starting + features_names[feature] + direction_string + str(value) + unit_measure
+
+def verbalise_explanation(feature, direction, value):
+    return get_verbalisation_table().explanation(feature, direction, value)
 
 
 def verbalise_suggestion(action):
-    action_subject_names = {
-        0: 'skip',
-        1: 'security rods',
-        2: 'security rods',
-        3: 'sustain rods',
-        4: 'sustain rods',
-        5: 'sustain rods',
-        6: 'fuel rods',
-        7: 'fuel rods',
-        8: 'regulatory rods',
-        9: 'regulatory rods',
-        10: 'regulatory rods',
-        11: 'water in the steam generator'
-    }
-
-    ending = ""
-    if action == 0:
-        phrase = "I would "
-    elif 0 < action < 11:
-        phrase = "I would set "
-        if action == 1 or action == 3 or action == 6 or action == 8:
-            ending = " up the "
-        elif action == 2 or action == 5 or action == 7 or action == 10:
-            ending = " down the "
-        elif action == 4 or action == 9:
-            ending = " middle the "
-    elif action == 11:
-        phrase = "I would add "
-    phrase += action_subject_names[action] + ending
-
-    return phrase
+    return get_verbalisation_table().suggestion(action)
 
 
 class Train(object):
@@ -146,7 +172,15 @@ class Train(object):
         self.qfunc = qfunc
         self.env = gym_env
 
-    def train(self, num_steps, eps_func, eval_only=False, track_data_per=0):
+    def train(self, num_steps, eps_func, eval_only=False, track_data_per=0, checkpoint_path=None,
+              checkpoint_every=100000, metrics=None):
+        """
+        :param checkpoint_path:  if not None, the training state is saved there every checkpoint_every steps (and at the
+                                 end); if a checkpoint is already there, the training resumes exactly from it
+                                 (self.env is replaced by the checkpoint's one).
+        :param metrics:          if not None, a TrainingMetrics collecting steps/sec, episodes, splits, tree size,
+                                 epsilon and rewards
+        """
         if eval_only:
             pass
             # self.qfunc.print_structure()
@@ -157,8 +191,37 @@ class Train(object):
         ts_per_ep = []
         num_eps = 0
         last_step_ep = -1
-        for step in range(num_steps):
+        s = None
+        start_step = 0
+
+        checkpoint = load_checkpoint(checkpoint_path)
+        if checkpoint is not None:
+            start_step = checkpoint["step"]
+            self.qfunc.set_state(checkpoint["qfunc"])
+            self.env = checkpoint["env"]
+            np.random.set_state(checkpoint["np_random"])
+            hist, ep_r, done, r_per_ep, ts_per_ep, num_eps, last_step_ep, s = checkpoint["loop"]
+        checkpoint_writer = CheckpointWriter(checkpoint_path) if checkpoint_path is not None else None
+        if metrics is not None:
+            metrics.start(start_step, self.qfunc.num_nodes())
+
+        def save_checkpoint(step):
+            checkpoint_writer.save({
+                "step": step,
+                "qfunc": self.qfunc.get_state(),
+                "env": self.env,
+                "np_random": np.random.get_state(),
+                "loop": (hist, ep_r, done, r_per_ep, ts_per_ep, num_eps, last_step_ep, s)
+            })
+
+        for step in range(start_step, num_steps):
+            if checkpoint_writer is not None and step > start_step and step % checkpoint_every == 0:
+                save_checkpoint(step)
+            if metrics is not None and step % metrics.record_every == 0:
+                metrics.record(step, eps_func(step))
             if done:
+                if metrics is not None and step > 0:
+                    metrics.on_episode(ep_r)
                 if eval_only and step > 0:
                     r_per_ep.append(ep_r)
                     ts = step - last_step_ep
@@ -174,16 +237,19 @@ class Train(object):
             if np.random.random() < eps_func(step):
                 a = self.env.action_space.sample()
             else:
-                s = convert_to_pystate(s)
-                a = self.qfunc.select_a(s)
+                a = self.qfunc.select_a(convert_to_pystate(s))
             s2, r, done, _ = self.env.step(a)
             if not eval_only:
-                s, s2 = convert_to_pystate(s), convert_to_pystate(s2)
-                a = Action(a)
-
-                self.qfunc.take_tuple(s, a, r, s2, done)
+                self.qfunc.take_tuple(convert_to_pystate(s), Action(a), r, convert_to_pystate(s2), done)
+                if metrics is not None and self.qfunc.just_split():
+                    metrics.on_split()
             s = s2
             ep_r += r
+        if checkpoint_writer is not None:
+            save_checkpoint(num_steps)
+            checkpoint_writer.close()
+        if metrics is not None:
+            metrics.close(num_steps, eps_func(num_steps))
         if eval_only:
             # avg_r_per_ep = np.mean(r_per_ep)
             avg_r_per_ep = r_per_ep
@@ -218,18 +284,59 @@ class NPPModel(QObject):
 
         self.DT.set_root_from_file(self.fileName.encode())
 
-        self.partner_model = PartnerModel(user_id, exp_type)
+        self.partner_model = PartnerModel(user_id, exp_type, model_filename="models/partner_model_" + user_id + ".npz")
+
+        # the partner model runs in a single background worker, so that k-means never stalls the GUI;
+        # its updates are queued there too, hence they keep the GUI's order
+        self.partner_model_executor = ThreadPoolExecutor(max_workers=1)
+        self.next_prediction = None     # future of the user's action prediction in the current env step
+        # saving rewrites the user's whole history: it is done every few confirmed actions and at exit
+        self.partner_model_save_every = 50
+        self.no_confirmed_actions = 0
+        atexit.register(self.save_partner_model)
+
+        self.verbalisation_table = VerbalisationTable(self.env.action_space.n, len(self.env.observation_space))
+
+        # (action, Q-values, leaf id) of the DT in the current env step
+        self.step_decision = None
 
     def restart(self):
+        self.step_decision = None
+        self.discard_prediction()
         self.env.reset()
 
+    def get_decision(self):
+        """
+        :return: (action, Q-values, leaf id) of the DT in the current env step, computed once per step.
+        """
+        if self.step_decision is None:
+            action, qs, leaf_id, _ = self.DT.decide(self.get_observation())
+            self.step_decision = (action, qs, leaf_id)
+        return self.step_decision
+
+    def explain(self, explanation_type, action=None, user_action=-1, using_higher_nodes=True):
+        """
+        :return: (feature, direction, value) explaining action (the DT's action if None) in the current env step.
+        """
+        obs = self.get_observation()
+        if action is None and self.step_decision is None:
+            # decision and explanation with a single descent
+            action, qs, leaf_id, explanation = self.DT.decide(obs, explanation_type, user_action, using_higher_nodes)
+            self.step_decision = (action, qs, leaf_id)
+            return explanation
+
+        if action is None:
+            action = self.step_decision[0]
+        if explanation_type == CLASSIC_EXPLANATION:
+            return self.DT.explain_classic(action, obs, using_higher_nodes)
+        return self.DT.explain_useraware(user_action, action, obs, using_higher_nodes)
+
     def get_DT_action(self):
         """
         :return: the action the DT'd perform in self.env.get_observation() scenario.
         """
         obs = self.env.get_observation()
-        pystate = convert_to_pystate(obs)
-        action = self.DT.select_a(pystate)
+        action = self.get_decision()[0]
 
         action = self.skip_action_patch(obs, action)
 
@@ -237,9 +344,9 @@ class NPPModel(QObject):
             return "Farei skip"
 
         if self.check_action_with_effects(obs, int(action)):
-            phrase = verbalise_suggestion(int(action))
+            phrase = self.verbalisation_table.suggestion(int(action))
         else:
-            phrase = verbalise_suggestion(0)    # "I'd skip"
+            phrase = self.verbalisation_table.suggestion(0)    # "I'd skip"
         return phrase
 
     def skip_action_patch(self, obs, action):
@@ -263,41 +370,32 @@ class NPPModel(QObject):
         return has_effects
 
     def get_classical_explanation(self, action=None):
-        obs = self.env.get_observation()
-        if action is None:
-            pystate = convert_to_pystate(obs)
-            action = self.DT.select_a(pystate)
-            action = int(action)
-
-        explanation = self.DT.explain_classic(action, obs, True)
-        expl_phrase = verbalise_explanation(explanation[0], explanation[1], explanation[2])
+        explanation = self.explain(CLASSIC_EXPLANATION, action, using_higher_nodes=True)
+        expl_phrase = self.verbalisation_table.explanation(explanation[0], explanation[1], explanation[2])
 
         return expl_phrase
 
     def get_useraware_explanation(self, action=None, user_indicated_action=None):
         obs = self.get_observation()
-        if action is None:
-            pystate = convert_to_pystate(obs)
-            action = self.DT.select_a(pystate)
-            action = int(action)
 
         if user_indicated_action is None:
-            user_action = self.partner_model.get_prediction(obs)
+            user_action = self.get_user_action_prediction()
         else:
             user_action = user_indicated_action
 
         if user_action is None:         # or user_action == action:
             print("GET_USERAWARE_EXPLANATION CALLS EXPLAIN_CLASSIC")
-            explanation = self.DT.explain_classic(action, obs, True)
+            explanation = self.explain(CLASSIC_EXPLANATION, action, using_higher_nodes=True)
         else:
             print("GET_USERAWARE_EXPLANATION CALLS EXPLAIN_USERAWARE")
-            explanation = self.DT.explain_useraware(user_action, action, obs, False)
+            explanation = self.explain(USERAWARE_EXPLANATION, action, int(user_action), using_higher_nodes=False)
 
-        expl_phrase = verbalise_explanation(explanation[0], explanation[1], explanation[2])
+        expl_phrase = self.verbalisation_table.explanation(explanation[0], explanation[1], explanation[2])
 
         return expl_phrase
 
     def perform_user_action(self, action):
+        self.step_decision = None
         obs, r, anomaly, info = self.env.step(int(action))
         if anomaly:
             self.anomaly_signal.emit()
@@ -339,11 +437,46 @@ class NPPModel(QObject):
                 print("BOOM!")
                 print(info)
 
+    def request_prediction(self, obs):
+        """
+        Starts computing the user's action prediction for obs in the partner model's worker.
+        """
+        self.discard_prediction()
+        self.next_prediction = self.partner_model_executor.submit(self.partner_model.get_prediction, obs)
+
+    def discard_prediction(self):
+        if self.next_prediction is not None:
+            self.next_prediction.cancel()
+            self.next_prediction = None
+
+    def get_user_action_prediction(self):
+        """
+        :return: the user's action prediction in the current env step; it waits only if it is still being computed.
+        """
+        if self.next_prediction is None:
+            self.request_prediction(self.get_observation())
+        return self.next_prediction.result()
+
     def comm_partner_model_confirmed_action(self, action):
-        self.partner_model.set_action_to_last_obs(action)
+        self.partner_model_executor.submit(self.partner_model.set_action_to_last_obs, action)
+        self.no_confirmed_actions += 1
+        if self.no_confirmed_actions % self.partner_model_save_every == 0:
+            self.partner_model_executor.submit(self.partner_model.save)
+
+        # the new label changes the clusters' frequencies: the pending prediction is recomputed
+        if self.next_prediction is not None:
+            self.request_prediction(self.get_observation())
+
+    def save_partner_model(self):
+        """
+        Waits for the partner model's queued updates, then saves it. Called at exit.
+        """
+        self.partner_model_executor.shutdown(wait=True)
+        self.partner_model.save()
 
     def comm_partner_model_action_declaration(self, action):
-        self.partner_model.set_last_action_declaration(action)
+        self.partner_model_executor.submit(self.partner_model.set_last_action_declaration, action)
 
     def comm_partner_model_obs(self, obs):
-        self.partner_model.add_observation(obs)
+        self.partner_model_executor.submit(self.partner_model.add_observation, obs)
+        self.request_prediction(obs)
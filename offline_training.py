@@ -0,0 +1,185 @@
+import argparse
+import csv
+import glob
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from model import QTree, Discrete, convert_to_pybox
+from NuclearPowerPlant import NuclearPowerPlant, SKIP
+
+NO_FEATURES = 8
+
+
+def read_session_log(filename):
+    """
+    Reads a partner model log (log/partner_model_<user>_<exp_type>.csv, one file per session).
+    :return: observations (n, 8) and confirmed actions (n,): each observation is the env's state right after its action
+    """
+    observations = []
+    actions = []
+    with open(filename, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        confirmed_column = header.index('confirmed_action')
+        for row in reader:
+            # rows logged before the first observation have no features
+            if row[0] == '' or row[confirmed_column] == '':
+                continue
+            observations.append([float(value) for value in row[:NO_FEATURES]])
+            actions.append(int(float(row[confirmed_column])))
+    return np.array(observations, dtype=np.float64).reshape(-1, NO_FEATURES), np.array(actions, dtype=np.int32)
+
+
+def set_observation(env, obs):
+    """
+    Brings the env's observable features to obs; the step counters are left as they are.
+    """
+    env.temperature_water_core = obs[0]
+    env.pressure_core = obs[1]
+    env.level_water_steam_generator = obs[2]
+    env.reactor_power = obs[3]
+    env.safety_rods = int(obs[4])
+    env.sustain_rods = int(obs[5])
+    env.fuel_rods = int(obs[6])
+    env.regulatory_rods = int(obs[7])
+
+
+def steps_from_power(obs):
+    """
+    :return: the env's no_steps before the step which led to obs, inferred from the reactor power (which decreases by
+             5.5 MW per step), or None if the power is at one of its bounds
+    """
+    if obs[3] <= 0. or obs[3] >= 1000.:
+        return None
+    power = 1000. + 200. * obs[5] - 200. * obs[7]
+    return int(round((power - obs[3]) / 5.5))
+
+
+def session_transitions(filename, max_skips=3):
+    """
+    Rebuilds the transitions of a logged session by replaying its actions through NuclearPowerPlant, starting each
+    of them from the previous logged state (the GUI restarts the env after an anomaly). The rewards also depend on the
+    env's step counters, which are replayed along.
+    When an action does not lead to the logged state, up to max_skips SKIP steps are tried before it (the GUI skips
+    the step, without any confirmed action, when the countdown expires), also with the step counter read from the
+    logged reactor power. If none matches, the transition is dropped and the replay goes on from the logged state.
+    :return: (s, a, r, s2, done) arrays, number of dropped transitions
+    """
+    observations, actions = read_session_log(filename)
+    transitions = []
+    dropped = 0
+
+    env = NuclearPowerPlant()
+    state = env.reset()
+    for obs, action in zip(observations, actions):
+        counters = (env.no_steps, env.no_critic_steps, env.prev_action)
+        no_steps = steps_from_power(obs)
+        attempts = []
+        for skips in range(max_skips + 1):
+            attempts.append((skips, env.no_steps))
+            if no_steps is not None and no_steps - skips >= 0 and no_steps - skips != env.no_steps:
+                attempts.append((skips, no_steps - skips))
+        for skips, start_steps in attempts:
+            env.no_steps, env.no_critic_steps, env.prev_action = counters
+            env.no_steps = start_steps
+            steps = []
+            curr = state
+            for a in [SKIP] * skips + [int(action)]:
+                set_observation(env, curr)
+                s2, r, done, _ = env.step(a)
+                steps.append((curr, a, r, s2, done))
+                curr = env.reset() if done and a == SKIP else s2
+            if np.allclose(s2, obs):
+                break
+        else:
+            # back to the counters of a plain step from the previous state
+            env.no_steps, env.no_critic_steps, env.prev_action = counters
+            set_observation(env, state)
+            env.step(int(action))
+            steps = []
+            dropped += 1
+
+        transitions.extend(steps)
+        state = env.reset() if done and steps else obs
+
+    if not transitions:
+        empty = np.zeros((0, NO_FEATURES))
+        return (empty, np.zeros(0, dtype=np.int32), np.zeros(0), empty, np.zeros(0, dtype=np.uint8)), dropped
+    s, a, r, s2, done = zip(*transitions)
+    return (np.array(s, dtype=np.float64), np.array(a, dtype=np.int32), np.array(r, dtype=np.float64),
+            np.array(s2, dtype=np.float64), np.array(done, dtype=np.uint8)), dropped
+
+
+def stream_transitions(filenames, batch_size, workers=1):
+    """
+    Yields the transitions of the sessions in batches of batch_size (the last one may be smaller), in the sessions'
+    order; the sessions are replayed by workers processes.
+    :return: generator of (s, a, r, s2, done), number of dropped transitions so far
+    """
+    pending = []
+    pending_size = 0
+    dropped = 0
+    pool = ProcessPoolExecutor(workers) if workers > 1 else None
+    sessions = pool.map(session_transitions, filenames) if pool is not None else map(session_transitions, filenames)
+    try:
+        for transitions, session_dropped in sessions:
+            dropped += session_dropped
+            pending.append(transitions)
+            pending_size += len(transitions[1])
+            while pending_size >= batch_size:
+                batch = [np.concatenate(arrays) for arrays in zip(*pending)]
+                yield tuple(array[:batch_size] for array in batch), dropped
+                pending = [tuple(array[batch_size:] for array in batch)]
+                pending_size -= batch_size
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    if pending_size > 0:
+        yield tuple(np.concatenate(arrays) for arrays in zip(*pending)), dropped
+
+
+def train_offline(qfunc, filenames, batch_size=4096, workers=1, verbose=False):
+    """
+    Feeds the transitions of the logged sessions to qfunc, in order, with take_tuple_batch.
+    :return: number of transitions taken, number of splits, number of dropped transitions
+    """
+    num_transitions = 0
+    num_splits = 0
+    dropped = 0
+    for batch, dropped in stream_transitions(filenames, batch_size, workers):
+        num_splits += qfunc.take_tuple_batch(*batch)
+        num_transitions += len(batch[1])
+        if verbose:
+            print(f"{num_transitions} transitions, {num_splits} splits, {qfunc.num_nodes()} nodes")
+    return num_transitions, num_splits, dropped
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Train the DT on the sessions logged by the GUI, without running "
+                                                 "the env live.")
+    parser.add_argument("--logs", default="log/partner_model_*.csv", help="glob of the partner model logs")
+    parser.add_argument("--tree", default=None, help="DT to start from (a new one if missing)")
+    parser.add_argument("--output", default="models/offline_DT.txt")
+    parser.add_argument("--batch-size", type=int, default=4096)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--gamma", type=float, default=0.8)
+    parser.add_argument("--alpha", type=float, default=0.01)
+    parser.add_argument("--split-thresh-max", type=float, default=1000000)
+    parser.add_argument("--num-splits", type=int, default=3)
+    parser.add_argument("--tree-params", action="store_true",
+                        help="continue with the training parameters saved in --tree instead of the ones above")
+    args = parser.parse_args()
+
+    env = NuclearPowerPlant()
+    DT = QTree(convert_to_pybox(env.observation_space), Discrete(env.action_space.n), None, gamma=args.gamma,
+               alpha=args.alpha, visit_decay=0.999, split_thresh_max=args.split_thresh_max, split_thresh_decay=0.99,
+               num_splits=args.num_splits)
+    if args.tree is not None:
+        DT.set_root_from_file(args.tree.encode(), load_params=args.tree_params)
+
+    filenames = sorted(glob.glob(args.logs))
+    num_transitions, num_splits, dropped = train_offline(DT, filenames, args.batch_size, args.workers, verbose=True)
+    print(f"{len(filenames)} sessions: {num_transitions} transitions, {dropped} dropped, {num_splits} splits, "
+          f"{DT.num_nodes()} nodes")
+    DT.save_to_file(args.output.encode())
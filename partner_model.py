@@ -1,7 +1,165 @@
 from sklearn.cluster import KMeans
 from sklearn.cluster import k_means
 import numpy as np
-import csv
+import os
+
+from log_writer import get_log_writer
+
+
+def assign_clusters(points, centroids):
+    """
+    :param points:    (n, f) array
+    :param centroids: (k, f) array
+    :return:          index of the nearest centroid of each point, computed with a single broadcast
+    """
+    distances = (points ** 2).sum(axis=1)[:, np.newaxis] - 2 * points @ centroids.T + (centroids ** 2).sum(axis=1)
+    return np.argmin(distances, axis=1)
+
+
+def move_centroid(centroids, cluster_sizes, actions_frequencies, cluster, obs, action):
+    """
+    Online (MacQueen) k-means step: the centroid of cluster moves towards obs, and counts its action.
+    """
+    cluster_sizes[cluster] += 1
+    centroids[cluster] += (obs - centroids[cluster]) / cluster_sizes[cluster]
+    actions_frequencies[cluster][action] += 1
+
+
+def seed_clusters(labelled, actions, k, no_actions):
+    """
+    Seeds k centroids with the first k distinct labelled observations, then feeds them the other ones.
+    :return: centroids, cluster sizes and actions frequencies (or None if there are less than k distinct observations)
+    """
+    _, first_occurrences = np.unique(labelled, axis=0, return_index=True)
+    if len(first_occurrences) < k:
+        return None
+
+    seeds = np.sort(first_occurrences)[:k]
+    centroids = labelled[seeds].astype(float)
+    cluster_sizes = np.ones(k)
+    actions_frequencies = np.zeros(shape=[k, no_actions])
+    for cluster, i in enumerate(seeds):
+        actions_frequencies[cluster][actions[i]] += 1
+
+    for i in np.setdiff1d(np.arange(len(labelled)), seeds):
+        cluster = np.argmin(((centroids - labelled[i]) ** 2).sum(axis=1))
+        move_centroid(centroids, cluster_sizes, actions_frequencies, cluster, labelled[i], actions[i])
+    return centroids, cluster_sizes, actions_frequencies
+
+
+class ClusteringCandidates:
+    """
+    Online k-means with several candidate k, kept in sync with the history only when k is re-evaluated.
+    The candidates' centroids are stored in one array, padded to the largest k, so that all of them learn a chunk of
+    observations with the same few array operations: in a chunk, the observations are assigned to the centroids as they
+    were at its start, then each centroid moves to the mean of its cluster.
+    The score of a candidate is the prequential accuracy: each labelled observation is predicted before being learned.
+    Since the centroids do not move within a chunk, it only approximates the score of one observation at a time
+    (chunk_size=1 gives that score exactly).
+    """
+
+    def __init__(self, ks, no_features, no_actions, decay=0.995, chunk_size=100):
+        self.ks = np.array(sorted(ks))
+        self.decay = decay          # of the past predictions' weight, to follow changes of the user's behaviour
+        self.chunk_size = chunk_size
+        # padding centroids are far from the normalized observations, so they never get any
+        self.centroids = np.full((len(self.ks), self.ks.max(), no_features), 1e6)
+        self.cluster_sizes = np.zeros((len(self.ks), self.ks.max()))
+        self.actions_frequencies = np.zeros((len(self.ks), self.ks.max(), no_actions))
+        self.seeded = np.zeros(len(self.ks), dtype=bool)
+        self.no_seen = 0            # labelled observations already learned by the seeded candidates
+        self.hits = np.zeros(len(self.ks))
+        self.predictions = np.zeros(len(self.ks))
+
+    def catch_up(self, labelled, actions):
+        seeded = np.flatnonzero(self.seeded)
+        if len(seeded) > 0:
+            for start in range(self.no_seen, len(labelled), self.chunk_size):
+                hits = self.learn(labelled[start:start + self.chunk_size], actions[start:start + self.chunk_size],
+                                  seeded)
+                # decayed sums of the chunk's hits, in order (the hits come from the centroids at the chunk's start)
+                weights = self.decay ** np.arange(len(hits) - 1, -1, -1)
+                self.hits[seeded] = self.decay ** len(hits) * self.hits[seeded] + weights @ hits
+                self.predictions[seeded] = self.decay ** len(hits) * self.predictions[seeded] + weights.sum()
+
+        # the others are seeded as the clustering in use, once
+        for candidate in np.flatnonzero(~self.seeded):
+            k = self.ks[candidate]
+            state = seed_clusters(labelled, actions, k, self.actions_frequencies.shape[2])
+            if state is None:
+                break
+            self.centroids[candidate, :k], self.cluster_sizes[candidate, :k], \
+                self.actions_frequencies[candidate, :k] = state
+            self.seeded[candidate] = True
+        self.no_seen = len(labelled)
+
+    def learn(self, observations, actions, candidates):
+        """
+        :return: bool array (observations, candidates), the candidates' prediction hits before learning
+        """
+        candidates = np.asarray(candidates)
+        no_candidates, k_max, no_features = len(candidates), self.centroids.shape[1], self.centroids.shape[2]
+        no_actions = self.actions_frequencies.shape[2]
+        centroids = self.centroids[candidates].reshape(-1, no_features)
+
+        # one distance computation for all the candidates, as in assign_clusters
+        distances = (centroids ** 2).sum(axis=1) - 2 * observations @ centroids.T
+        clusters = distances.reshape(len(observations), no_candidates, k_max).argmin(axis=2)
+        centroids_actions = self.actions_frequencies[candidates].argmax(axis=2).T
+        hits = np.take_along_axis(centroids_actions, clusters, axis=0) == actions[:, np.newaxis]
+
+        # counts, sums and actions of the clusters with a (observations, all the clusters) assignment matrix
+        assignments = (clusters[:, :, np.newaxis] == np.arange(k_max)).reshape(len(observations), -1).T.astype(float)
+        counts = assignments.sum(axis=1)
+        sums = assignments @ observations
+        cluster_sizes = self.cluster_sizes[candidates].ravel() + counts
+        grown = counts > 0
+        centroids[grown] += (sums[grown] - counts[grown, np.newaxis] * centroids[grown]) / \
+                            cluster_sizes[grown, np.newaxis]
+        self.centroids[candidates] = centroids.reshape(no_candidates, k_max, no_features)
+        self.cluster_sizes[candidates] = cluster_sizes.reshape(no_candidates, k_max)
+        self.actions_frequencies[candidates] += (assignments @ np.eye(no_actions)[actions]).reshape(
+            no_candidates, k_max, no_actions)
+        return hits
+
+    def accuracies(self):
+        """
+        :return: accuracy of each candidate, nan for the ones which did not predict yet
+        """
+        return np.divide(self.hits, self.predictions, out=np.full(len(self.ks), np.nan), where=self.predictions > 0)
+
+    def state(self, candidate):
+        """
+        :return: copies of the candidate's centroids, cluster sizes and actions frequencies
+        """
+        k = self.ks[candidate]
+        return self.centroids[candidate, :k].copy(), self.cluster_sizes[candidate, :k].copy(), \
+               self.actions_frequencies[candidate, :k].copy()
+
+
+class GrowableArray:
+    """
+    Array of rows which doubles its capacity when full, so that appending is amortised O(1).
+    The stored rows are exposed as a view, without copies.
+    """
+
+    def __init__(self, row_shape=(), dtype=float, capacity=1024):
+        self.data = np.empty(shape=(capacity,) + tuple(row_shape), dtype=dtype)
+        self.size = 0
+
+    def append(self, row):
+        if self.size == len(self.data):
+            grown = np.empty(shape=(max(1, 2 * len(self.data)),) + self.data.shape[1:], dtype=self.data.dtype)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+        self.data[self.size] = row
+        self.size += 1
+
+    def view(self):
+        return self.data[:self.size]
+
+    def __len__(self):
+        return self.size
 
 
 class PartnerModel:
@@ -9,13 +167,11 @@ class PartnerModel:
 
     """
 
-    def __init__(self, user_id, exp_type):
+    def __init__(self, user_id, exp_type, incremental=True, capacity=1024, random_state=None, model_filename=None,
+                 k_candidates=None, k_selection_interval=100):
         self.k = 12
         self.no_features = 8
-        self.observations = np.empty(shape=[0, self.no_features])
-        self.observations = np.append(self.observations, [[80, 30, 120, 0, 1, 0, 1., 0]], axis=0)   # first obs
-        self.actions_declared = np.empty(shape=[0, 1], dtype=int)
-        self.actions_frequencies = np.zeros(shape=[self.k, self.k])   # rows represent clusters, columns the users' actions frequencies
+        self.no_actions = 12
 
         # boundaries of the environment's features
         self.temperature_water_core_boundaries = np.array([80, 380])
@@ -27,16 +183,62 @@ class PartnerModel:
         self.fuel_rods_boundaries = np.array([0, 1])
         self.regulatory_rods_boundaries = np.array([0, 2])
 
+        # observations are stored and queried normalized: (obs - offset) * scale
+        boundaries = np.array([self.temperature_water_core_boundaries, self.pressure_core_boundaries,
+                               self.level_water_steam_generator_boundaries, self.reactor_power_boundaries,
+                               self.safety_rods_boundaries, self.sustain_rods_boundaries,
+                               self.fuel_rods_boundaries, self.regulatory_rods_boundaries], dtype=float)
+        self.normalization_offset = boundaries.min(axis=1)
+        self.normalization_scale = 1.0 / (boundaries.max(axis=1) - boundaries.min(axis=1))
+
+        self.features_names = ['temperature_water_core', 'pressure_core', 'level_water_steam_generator', 'reactor_power',
+                               'safety_rods', 'sustain_rods', 'fuel_rods', 'regulatory_rods']
+        self.first_obs = np.array([80, 30, 120, 0, 1, 0, 1., 0])
+        self.observations_buffer = GrowableArray((self.no_features,), float, capacity)
+        self.observations_buffer.append(self.normalize_observation_values(self.first_obs))
+        self.actions_buffer = GrowableArray((), int, capacity)
+        self.actions_frequencies = np.zeros(shape=[self.k, self.no_actions])   # rows represent clusters, columns the users' actions frequencies
+
+        # incremental (online) k-means: centroids and frequencies are updated as the actions arrive,
+        # instead of re-running k-means on the whole history at each prediction
+        self.incremental = incremental
+        self.random_state = random_state    # seed of the batch k-means
+        self.centroids = None
+        self.cluster_sizes = np.zeros(self.k)
+        self.centroids_actions = None   # most frequent action of each cluster, kept in sync with the frequencies
+
+        # adaptive k (incremental mode only): every k_selection_interval labelled observations, the candidates catch up
+        # with the history and the most accurate one replaces the clustering in use if it has another k
+        self.k_candidates = None
+        self.k_selection_interval = k_selection_interval
+        if k_candidates is not None and incremental:
+            self.k_candidates = ClusteringCandidates(k_candidates, self.no_features, self.no_actions)
+            if self.k not in k_candidates:
+                self.k = int(self.k_candidates.ks[0])
+                self.cluster_sizes = np.zeros(self.k)
+
         self.last_action_declaration = None
         self.last_obs = None
         self.last_action_confirmed = None
         self.last_prediction = None
         self.user_id = user_id
 
+        # a returning user's model is warm-started from the previous sessions
+        self.model_filename = model_filename
+        if model_filename is not None and os.path.exists(model_filename):
+            self.load(model_filename)
+
         log_filename = 'log/partner_model_' + user_id + '_' + str(exp_type) + '.csv'
-        self.file_log = open(log_filename, 'w')
-        self.file_log_writer = csv.writer(self.file_log)
-        self.file_log_writer.writerow(['observation', 'declared_action', 'prediction', 'confirmed_action'])
+        self.file_log = get_log_writer().open(log_filename, self.features_names +
+                                              ['declared_action', 'prediction', 'confirmed_action'])
+
+    @property
+    def observations(self):
+        return self.observations_buffer.view()
+
+    @property
+    def actions_declared(self):
+        return self.actions_buffer.view()
 
     def normalize_observation_values(self, obs):
         """
@@ -44,25 +246,10 @@ class PartnerModel:
                                 self.reactor_power, self.safety_rods,
                                 self.sustain_rods, self.fuel_rods, self.regulatory_rods],
                             dtype=np.float)
+                    or an array of such observations, one per row. It is not modified.
         :return: normalized (between [0, 1]) obs
         """
-        obs[0] = (obs[0] - self.temperature_water_core_boundaries.min()) / \
-                 (self.temperature_water_core_boundaries.max() - self.temperature_water_core_boundaries.min())
-        obs[1] = (obs[1] - self.pressure_core_boundaries.min()) / \
-                 (self.pressure_core_boundaries.max() - self.pressure_core_boundaries.min())
-        obs[2] = (obs[2] - self.level_water_steam_generator_boundaries.min()) / \
-                 (self.level_water_steam_generator_boundaries.max() - self.level_water_steam_generator_boundaries.min())
-        obs[3] = (obs[3] - self.reactor_power_boundaries.min()) / \
-                 (self.reactor_power_boundaries.max() - self.reactor_power_boundaries.min())
-        obs[4] = (obs[4] - self.safety_rods_boundaries.min()) / \
-                 (self.safety_rods_boundaries.max() - self.safety_rods_boundaries.min())
-        obs[5] = (obs[5] - self.sustain_rods_boundaries.min()) / \
-                 (self.sustain_rods_boundaries.max() - self.sustain_rods_boundaries.min())
-        obs[6] = (obs[6] - self.fuel_rods_boundaries.min()) / \
-                 (self.fuel_rods_boundaries.max() - self.fuel_rods_boundaries.min())
-        obs[7] = (obs[7] - self.regulatory_rods_boundaries.min()) / \
-                 (self.regulatory_rods_boundaries.max() - self.regulatory_rods_boundaries.min())
-        return obs
+        return (np.asarray(obs, dtype=float) - self.normalization_offset) * self.normalization_scale
 
     def get_prediction(self, obs):
         """
@@ -71,55 +258,188 @@ class PartnerModel:
         """
 
         # self.last_obs = obs
+        obs = self.normalize_observation_values(obs)
+
+        if self.incremental:
+            if self.centroids is None:
+                return None
+            action_prediction = self.centroids_actions[self.nearest_centroid(obs)]
+        else:
+            action_prediction = self.get_batch_prediction(obs)
+            if action_prediction is None:
+                return None
+
+        print("ACTION FREQUENCES:", self.actions_frequencies)
+        print("USER'S ACTION PREDICTION:", action_prediction)
+
+        self.last_prediction = action_prediction
+
+        return action_prediction
+
+    def predict_batch(self, observations):
+        """
+        Predictions of many observations at once, e.g. to replay a logged session. Unlike get_prediction, it neither
+        prints nor records the last prediction; in batch mode k-means runs once for all the observations.
+        :param observations: (n, 8) array, not normalized
+        :return:             (n,) array of action predictions (or None if the clusters are not available yet)
+        """
+        observations = self.normalize_observation_values(observations)
+
+        if self.incremental:
+            if self.centroids is None:
+                return None
+            return self.centroids_actions[assign_clusters(observations, self.centroids)]
+
+        centroids = self.fit_batch_clusters()
+        if centroids is None:
+            return None
+        return self.centroids_actions[assign_clusters(observations, centroids)]
+
+    def get_batch_prediction(self, obs):
+        """
+        Runs k-means on all the observations collected so far.
+        :param obs: new observation
+        :return:    action prediction (or None if it cannot perform k-means)
+        """
+        centroids = self.fit_batch_clusters()
+        if centroids is None:
+            return None
+
+        # find the cluster that obs belongs to, and its most frequent action
+        return self.centroids_actions[assign_clusters(obs[np.newaxis], centroids)[0]]
+
+    def fit_batch_clusters(self):
+        """
+        Runs k-means on all the observations collected so far and updates the frequencies.
+        :return: the centroids (or None if there are less than k observations)
+        """
 
         # perform k-means
         if len(self.observations) < self.k:
             return None
-        centroids, labels, inertia = k_means(self.observations, self.k)
+        centroids, labels, inertia = k_means(self.observations, self.k, random_state=self.random_state)
 
         # update self.action_frequencies
-        i = 0
-        self.actions_frequencies.fill(0)
         # for each observation but the new one (because it doesn't have an associated action already
-        for x in self.observations[:-1]:
-            cluster = np.argmin([np.linalg.norm(x - b) for b in centroids])
-            action = self.actions_declared[i]
-            # print("indexes:", cluster, action)
-            self.actions_frequencies[cluster][action] += 1
-            i += 1
+        no_labelled = min(len(self.observations) - 1, len(self.actions_declared))
+        clusters = assign_clusters(self.observations[:no_labelled], centroids)
+        no_actions = self.actions_frequencies.shape[1]
+        self.actions_frequencies[:] = np.bincount(clusters * no_actions + self.actions_declared[:no_labelled],
+                                                  minlength=self.k * no_actions).reshape(self.k, no_actions)
+        self.centroids_actions = np.argmax(self.actions_frequencies, axis=1)
 
-        # find the cluster that obs belongs to
-        curr_centroid = np.argmin([np.linalg.norm(obs - b) for b in centroids])
+        return centroids
 
-        # retrieve frequencies of that cluster
-        action_prediction = np.argmax(self.actions_frequencies[curr_centroid])
+    def nearest_centroid(self, obs):
+        return np.argmin(((self.centroids - obs) ** 2).sum(axis=1))
 
-        print("ACTION FREQUENCES:", self.actions_frequencies)
-        print("USER'S ACTION PREDICTION:", action_prediction)
+    def update_clusters(self):
+        """
+        Online (MacQueen) k-means step with the last observation that received an action: its nearest centroid
+        moves towards it and counts the action in the frequency table.
+        """
+        if not self.incremental:
+            return
 
-        self.last_prediction = action_prediction
+        no_labelled = len(self.actions_declared)
+        if self.centroids is None:
+            self.init_clusters(no_labelled)
+        else:
+            obs = self.observations[no_labelled - 1]
+            cluster = self.nearest_centroid(obs)
+            move_centroid(self.centroids, self.cluster_sizes, self.actions_frequencies, cluster, obs,
+                          self.actions_declared[no_labelled - 1])
+            self.centroids_actions[cluster] = np.argmax(self.actions_frequencies[cluster])
 
-        return action_prediction
+        if self.k_candidates is not None and no_labelled % self.k_selection_interval == 0:
+            self.select_k(no_labelled)
+
+    def init_clusters(self, no_labelled):
+        """
+        Seeds the centroids with the first k distinct observations that received an action, then feeds them the
+        other ones. It happens once, as soon as k distinct observations are available.
+        """
+        state = seed_clusters(self.observations[:no_labelled], self.actions_declared, self.k, self.no_actions)
+        if state is not None:
+            self.centroids, self.cluster_sizes, self.actions_frequencies = state
+            self.centroids_actions = np.argmax(self.actions_frequencies, axis=1)
+
+    def select_k(self, no_labelled):
+        """
+        Brings the candidates up to date and, if the most accurate one has another k, uses its clustering; otherwise
+        the online clustering in use is kept.
+        """
+        self.k_candidates.catch_up(self.observations[:no_labelled], self.actions_declared)
+        accuracies = self.k_candidates.accuracies()
+        if np.isnan(accuracies).all():
+            # no candidate has been evaluated yet: keep the current k
+            return
+
+        best = np.nanargmax(accuracies)
+        if self.k_candidates.ks[best] == self.k and self.centroids is not None:
+            return
+        self.k = int(self.k_candidates.ks[best])
+        self.centroids, self.cluster_sizes, self.actions_frequencies = self.k_candidates.state(best)
+        self.centroids_actions = np.argmax(self.actions_frequencies, axis=1)
+
+    def save(self, filename=None):
+        """
+        Saves the labelled observations (normalized), their actions and the clustering state in a .npz file.
+        The file is written aside and then renamed, so that an interrupted save never corrupts the previous one.
+        :param filename: the model_filename given at init if None
+        """
+        if filename is None:
+            filename = self.model_filename
+        no_labelled = len(self.actions_declared)
+        tmp_filename = filename + '.tmp.npz'
+        np.savez(tmp_filename, observations=self.observations[:no_labelled], actions=self.actions_declared,
+                 centroids=np.empty((0, self.no_features)) if self.centroids is None else self.centroids,
+                 cluster_sizes=self.cluster_sizes, actions_frequencies=self.actions_frequencies)
+        os.replace(tmp_filename, filename)
+
+    def load(self, filename):
+        """
+        Restores a model saved with save(). The new session's first observation follows the loaded history.
+        """
+        with np.load(filename) as data:
+            observations, actions = data['observations'], data['actions']
+            capacity = max(len(self.observations_buffer.data), 2 * (len(actions) + 1))
+            self.observations_buffer = GrowableArray((self.no_features,), float, capacity)
+            self.actions_buffer = GrowableArray((), int, capacity)
+            self.observations_buffer.data[:len(observations)] = observations
+            self.observations_buffer.size = len(observations)
+            self.actions_buffer.data[:len(actions)] = actions
+            self.actions_buffer.size = len(actions)
+            self.observations_buffer.append(self.normalize_observation_values(self.first_obs))
+
+            self.centroids = data['centroids'].copy() if len(data['centroids']) else None
+            if self.centroids is not None:
+                self.k = len(self.centroids)
+            self.cluster_sizes = data['cluster_sizes'].copy()
+            self.actions_frequencies = data['actions_frequencies'].copy()
+            self.centroids_actions = np.argmax(self.actions_frequencies, axis=1)
 
     def set_action_to_last_obs(self, action):
 
         if self.last_action_declaration is not None:
-            self.actions_declared = np.append(self.actions_declared, self.last_action_declaration)
+            self.actions_buffer.append(self.last_action_declaration)
 
             print("saved action declaration")
             self.last_action_confirmed = action
+            self.update_clusters()
             self.log()
             self.last_action_declaration = None
         else:
-            self.actions_declared = np.append(self.actions_declared, action)
+            self.actions_buffer.append(action)
             self.last_action_declaration = action
             self.last_action_confirmed = action
+            self.update_clusters()
             self.log()
 
             print("saved action performed")
 
     def add_observation(self, obs):
-        self.observations = np.append(self.observations, [obs], axis=0)
+        self.observations_buffer.append(self.normalize_observation_values(obs))
         self.last_obs = obs
 
     def set_last_action_declaration(self, action):
@@ -134,4 +454,5 @@ class PartnerModel:
         print(self.actions_declared)
 
     def log(self):
-        self.file_log_writer.writerow([self.last_obs, self.last_action_declaration, self.last_prediction, self.last_action_confirmed])
+        obs = [None] * self.no_features if self.last_obs is None else np.asarray(self.last_obs, dtype=float).tolist()
+        self.file_log.writerow(obs + [self.last_action_declaration, self.last_prediction, self.last_action_confirmed])
@@ -0,0 +1,323 @@
+import argparse
+import asyncio
+import json
+import os
+import re
+import socket
+
+import numpy as np
+
+from model import QTree, Discrete, convert_to_pybox, get_verbalisation_table
+from model import CLASSIC_EXPLANATION, USERAWARE_EXPLANATION
+from NuclearPowerPlant import NuclearPowerPlant
+from partner_model import PartnerModel
+
+NO_FEATURES = 8
+
+# the user id is part of the partner model's filenames
+USER_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]+")
+
+
+class Session:
+    """
+    State of a user connected to the service: its partner model and the explanations it already received.
+    """
+
+    def __init__(self, partner_model, explanation_history):
+        self.partner_model = partner_model
+        self.explanation_history = explanation_history
+        self.no_confirmed_actions = 0
+
+
+class PartnerModelService:
+    """
+    Hosts one DT, loaded once, and the partner models of many users. Clients send one JSON object per line:
+        {"id": ..., "user": ..., "op": ..., other arguments}
+    and receive {"id": ..., "result": ...} or {"id": ..., "error": ...}.
+    Requests from all the clients are collected in batches, executed by a single worker thread. The predictions of a
+    user in a batch are computed at once, and so are the DT's decisions of all the users (see execute_batch).
+    Partner models are saved every save_every confirmed actions, when their session is closed and when the service
+    stops: saving rewrites the user's whole history.
+
+    Operations:
+        open        {"exp_type"}                    creates the user's session (warm-starting its partner model);
+                                                    the user id may only contain letters, digits, '_' and '-'
+        close       {}                              saves the partner model and ends the session
+        observe     {"obs"}                         PartnerModel.add_observation
+        declare     {"action"}                      PartnerModel.set_last_action_declaration
+        confirm     {"action"}                      PartnerModel.set_action_to_last_obs
+        predict     {"obs"}                         user's action prediction (None if not available)
+        decide      {"obs"}                         [action, Q-values] of the DT
+        explain     {"obs", "explanation_type", "action", "user_action", "using_higher_nodes"}
+                                                    [feature, direction, value, phrase]; action is the DT's one if
+                                                    missing, user_action is predicted if missing in useraware ones
+    """
+
+    def __init__(self, tree_filename, max_batch_size=64, batch_window=0.002, save_every=50):
+        env = NuclearPowerPlant()
+        self.DT = QTree(convert_to_pybox(env.observation_space), Discrete(env.action_space.n), None, gamma=0.8,
+                        alpha=0.01, visit_decay=0.999, split_thresh_max=1000000, split_thresh_decay=0.99, num_splits=3)
+        self.DT.set_root_from_file(tree_filename.encode())
+        self.empty_explanation_history = self.DT.explanation_history()
+
+        self.sessions = {}
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.save_every = save_every
+        self.requests = None
+
+    async def serve(self, socket_path):
+        self.requests = asyncio.Queue()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = await asyncio.start_unix_server(self.handle_client, path=socket_path)
+        try:
+            async with server:
+                await asyncio.gather(server.serve_forever(), self.process_requests())
+        finally:
+            for session in self.sessions.values():
+                session.partner_model.save()
+
+    async def handle_client(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except json.JSONDecodeError as e:
+                    response = {"id": None, "error": repr(e)}
+                else:
+                    future = loop.create_future()
+                    await self.requests.put((request, future))
+                    response = await future
+                writer.write((json.dumps(response) + '\n').encode())
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def process_requests(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.requests.get()]
+
+            # wait a bit for the requests of the other stations
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.requests.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            responses = await loop.run_in_executor(None, self.execute_batch, [request for request, _ in batch])
+            for (_, future), response in zip(batch, responses):
+                future.set_result(response)
+
+    def execute_batch(self, requests):
+        """
+        Executes the requests in arrival order for each user. Predictions and decisions change no state, so they are
+        set aside and computed together: a user's pending predictions with a single PartnerModel.predict_batch, before
+        any other request of the same user, and all the decisions with a single decide_batch of the DT.
+        """
+        responses = [None] * len(requests)
+        predictions = {}    # user -> indices of its predict requests not executed yet
+        decisions = []
+        for i, request in enumerate(requests):
+            try:
+                if not isinstance(request, dict):
+                    raise ValueError("the request is not a JSON object")
+                user_id = request.get("user")
+                if request.get("op") == "decide":
+                    decisions.append(i)
+                elif request.get("op") == "predict" and user_id in self.sessions:
+                    predictions.setdefault(user_id, []).append(i)
+                else:
+                    self.execute_predictions(requests, responses, predictions.pop(user_id, []))
+                    responses[i] = {"id": request.get("id"), "result": self.execute(request)}
+            except Exception as e:
+                responses[i] = error_response(request, e)
+
+        for user_id, indices in predictions.items():
+            self.execute_predictions(requests, responses, indices)
+        self.execute_decisions(requests, responses, decisions)
+        return responses
+
+    def execute_predictions(self, requests, responses, indices):
+        """
+        Predictions of the requests at indices, all of the same user.
+        """
+        indices, observations = self.read_observations(requests, responses, indices)
+        if len(indices) == 0:
+            return
+        partner_model = self.sessions[requests[indices[0]]["user"]].partner_model
+        try:
+            predictions = partner_model.predict_batch(observations)
+        except Exception as e:
+            for i in indices:
+                responses[i] = error_response(requests[i], e)
+            return
+
+        if predictions is None:
+            predictions = [None] * len(indices)
+        else:
+            partner_model.last_prediction = predictions[-1]
+        for i, prediction in zip(indices, predictions):
+            responses[i] = {"id": requests[i].get("id"), "result": to_json(prediction)}
+
+    def execute_decisions(self, requests, responses, indices):
+        indices, observations = self.read_observations(requests, responses, indices)
+        if len(indices) == 0:
+            return
+        try:
+            actions, qs = self.DT.decide_batch(observations)
+        except Exception as e:
+            for i in indices:
+                responses[i] = error_response(requests[i], e)
+            return
+
+        for i, action, action_qs in zip(indices, actions, qs):
+            responses[i] = {"id": requests[i].get("id"), "result": [int(action), action_qs.tolist()]}
+
+    def read_observations(self, requests, responses, indices):
+        """
+        Reads the observations of the requests at indices; the invalid ones are answered with an error.
+        :return: indices of the valid requests, their observations (n, 8)
+        """
+        valid = []
+        observations = []
+        for i in indices:
+            try:
+                observations.append(read_observation(requests[i]))
+                valid.append(i)
+            except Exception as e:
+                responses[i] = error_response(requests[i], e)
+        return valid, np.array(observations, dtype=float).reshape(-1, NO_FEATURES)
+
+    def execute(self, request):
+        user_id = request["user"]
+        op = request["op"]
+
+        if op == "open":
+            if not isinstance(user_id, str) or USER_ID_PATTERN.fullmatch(user_id) is None:
+                raise ValueError("invalid user id " + repr(user_id))
+            if user_id not in self.sessions:
+                partner_model = PartnerModel(user_id, request.get("exp_type", "service"),
+                                             model_filename="models/partner_model_" + user_id + ".npz")
+                self.sessions[user_id] = Session(partner_model, self.empty_explanation_history)
+            return None
+
+        session = self.sessions[user_id]
+        partner_model = session.partner_model
+
+        if op == "close":
+            partner_model.save()
+            del self.sessions[user_id]
+            return None
+        if op == "observe":
+            partner_model.add_observation(read_observation(request))
+            return None
+        if op == "declare":
+            partner_model.set_last_action_declaration(request["action"])
+            return None
+        if op == "confirm":
+            partner_model.set_action_to_last_obs(request["action"])
+            session.no_confirmed_actions += 1
+            if session.no_confirmed_actions % self.save_every == 0:
+                partner_model.save()
+            return None
+        if op == "predict":
+            return to_json(partner_model.get_prediction(read_observation(request)))
+        if op == "explain":
+            return self.explain(session, request)
+        raise ValueError("unknown op " + str(op))
+
+    def explain(self, session, request):
+        obs = read_observation(request)
+        explanation_type = request.get("explanation_type", CLASSIC_EXPLANATION)
+        action = request.get("action")
+        user_action = request.get("user_action")
+        using_higher_nodes = request.get("using_higher_nodes", explanation_type == CLASSIC_EXPLANATION)
+
+        if explanation_type == USERAWARE_EXPLANATION and user_action is None:
+            user_action = session.partner_model.get_prediction(obs)
+            if user_action is None:
+                explanation_type, using_higher_nodes = CLASSIC_EXPLANATION, True
+        user_action = -1 if user_action is None else int(user_action)
+
+        # the DT is shared: it explains with the user's own history
+        self.DT.set_explanation_history(session.explanation_history)
+        if action is None:
+            explanation = self.DT.decide(obs, explanation_type, user_action, using_higher_nodes)[3]
+        elif explanation_type == CLASSIC_EXPLANATION:
+            explanation = self.DT.explain_classic(action, obs, using_higher_nodes)
+        else:
+            explanation = self.DT.explain_useraware(user_action, action, obs, using_higher_nodes)
+        session.explanation_history = self.DT.explanation_history()
+
+        phrase = get_verbalisation_table().explanation(explanation[0], explanation[1], explanation[2])
+        return list(explanation) + [phrase]
+
+
+def to_json(value):
+    return None if value is None else int(value)
+
+
+def read_observation(request):
+    obs = np.array(request["obs"], dtype=float)
+    if obs.shape != (NO_FEATURES,):
+        raise ValueError("obs must have %d features" % NO_FEATURES)
+    return obs
+
+
+def error_response(request, e):
+    return {"id": request.get("id") if isinstance(request, dict) else None, "error": repr(e)}
+
+
+class PartnerModelClient:
+    """
+    Blocking client of a PartnerModelService, for a single station.
+    """
+
+    def __init__(self, user_id, socket_path, exp_type="service"):
+        self.user_id = user_id
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(socket_path)
+        self.file = self.socket.makefile('rw')
+        self.next_id = 0
+        self.request("open", exp_type=exp_type)
+
+    def request(self, op, **kwargs):
+        """
+        :return: the result of the operation
+        """
+        self.next_id += 1
+        kwargs.update({"id": self.next_id, "user": self.user_id, "op": op})
+        self.file.write(json.dumps(kwargs) + '\n')
+        self.file.flush()
+        response = json.loads(self.file.readline())
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response["result"]
+
+    def close(self):
+        self.request("close")
+        self.file.close()
+        self.socket.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve the DT and the partner models of many users on a local socket.")
+    parser.add_argument("--tree", default="models/winner_DT.txt")
+    parser.add_argument("--socket", default="/tmp/npp_partner_model.sock")
+    parser.add_argument("--max-batch-size", type=int, default=64)
+    parser.add_argument("--batch-window", type=float, default=0.002, help="seconds")
+    parser.add_argument("--save-every", type=int, default=50, help="confirmed actions of a user")
+    args = parser.parse_args()
+
+    service = PartnerModelService(args.tree, args.max_batch_size, args.batch_window, args.save_every)
+    asyncio.run(service.serve(args.socket))
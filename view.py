@@ -11,6 +11,7 @@ from PyQt5.QtWidgets import QLabel, QWidget, QPushButton, QVBoxLayout, QHBoxLayo
 from PyQt5.QtWidgets import QStyle, QStyleOptionSlider
 
 from model import NPPModel
+from log_writer import get_log_writer
 
 # ACTIONS' CODES
 SKIP = 0
@@ -179,6 +180,7 @@ class NPPGui(QWidget):
         self.user_id = user_id
 
         self.control = control
+        self.log_writer = get_log_writer()
         self.condition = condition
         self.exp_type = exp_type
 
@@ -414,9 +416,9 @@ class NPPGui(QWidget):
         self.npp_obj.comm_partner_model_obs(obs)
         self.set_features_labels(obs, info['energy'])
 
-        self.control.log_on_data_dumper(["OBSERVATION", str(obs)])
-        self.control.log_on_data_dumper(["NOT ASKED ICUB ACTION", icub_action_phrase])
-        self.control.log_on_data_dumper(["ENERGY", str(info['energy'])])
+        self.log_on_data_dumper(["OBSERVATION"] + [float(value) for value in obs])
+        self.log_on_data_dumper(["NOT ASKED ICUB ACTION", icub_action_phrase])
+        self.log_on_data_dumper(["ENERGY", float(info['energy'])])
         if anomaly:
             self.control.anomaly_detected(info['info_anomalies'])
 
@@ -435,6 +437,13 @@ class NPPGui(QWidget):
             self.regulatory_slider.setValue(self.regulatory_rods_pos)
             self.sustain_slider.setValue(self.sustain_rods_pos)
 
+    def log_on_data_dumper(self, *args):
+        """
+        The data dumper is called by the log writer's thread, in the same order of the calls. The rows are participant
+        data: if the writer falls behind, the GUI waits rather than losing them.
+        """
+        self.log_writer.submit(self.control.log_on_data_dumper, *args)
+
     def set_features_labels(self, obs, energy=None):
         self.temperature_box.setText("{:.1f}".format(obs[0]) + ' °C')
         self.pressure_box.setText("{:.1f}".format(obs[1]) + ' ATM')
@@ -551,7 +560,7 @@ class NPPGui(QWidget):
                 self.do_action_routine(confirmed_action)
                 self.npp_obj.comm_partner_model_confirmed_action(confirmed_action)
 
-            self.control.log_on_data_dumper(["CONFIRMED ACTION", command])
+            self.log_on_data_dumper(["CONFIRMED ACTION", command])
             self.indicated_action = None
 
         if self.ask_why_button.isEnabled():
@@ -560,7 +569,7 @@ class NPPGui(QWidget):
         self.ask_icub_button.setEnabled(False)
 
     def skip_button_clicked(self):
-        self.control.log_on_data_dumper(["GUI INTERACTION", "SKIP BUTTON"])
+        self.log_on_data_dumper(["GUI INTERACTION", "SKIP BUTTON"])
 
         # if their value changed without confirming...
         self.regulatory_slider.setValue(self.regulatory_rods_pos)
@@ -577,7 +586,7 @@ class NPPGui(QWidget):
             self.ask_icub_button.setEnabled(True)
 
     def water_button_clicked(self):
-        self.control.log_on_data_dumper(["GUI INTERACTION", "WATER BUTTON"])
+        self.log_on_data_dumper(["GUI INTERACTION", "WATER BUTTON"])
 
         # if their value changed without confirming...
         self.regulatory_slider.setValue(self.regulatory_rods_pos)
@@ -594,7 +603,7 @@ class NPPGui(QWidget):
             self.ask_icub_button.setEnabled(True)
 
     def ask_icub_button_clicked(self):
-        self.control.log_on_data_dumper(["GUI INTERACTION", "ASK WHAT BUTTON"])
+        self.log_on_data_dumper(["GUI INTERACTION", "ASK WHAT BUTTON"])
 
         action_phrase = self.npp_obj.get_DT_action()
         self.control.user_asked_what(action_phrase)
@@ -605,7 +614,7 @@ class NPPGui(QWidget):
         self.ask_icub_button.setEnabled(False)
 
     def ask_why_button_clicked(self):
-        self.control.log_on_data_dumper(["GUI INTERACTION", "ASK WHY BUTTON"])
+        self.log_on_data_dumper(["GUI INTERACTION", "ASK WHY BUTTON"])
 
         if self.condition == 'classical':
             explanation = self.npp_obj.get_classical_explanation()
@@ -620,7 +629,7 @@ class NPPGui(QWidget):
         curr_fuel_value = self.fuel_slider.getValue()
 
         if curr_fuel_value != self.fuel_rods_pos:
-            self.control.log_on_data_dumper(["GUI INTERACTION", "FUEL SLIDER"], curr_fuel_value)
+            self.log_on_data_dumper(["GUI INTERACTION", "FUEL SLIDER"], curr_fuel_value)
 
             curr_fuel_rods_pos = self.fuel_slider.getValue()
             if self.fuel_rods_pos == 0:
@@ -647,7 +656,7 @@ class NPPGui(QWidget):
         curr_regulatory_value = self.regulatory_slider.getValue()
 
         if curr_regulatory_value != self.regulatory_rods_pos:
-            self.control.log_on_data_dumper(["GUI INTERACTION", "REGULATORY SLIDER"], curr_regulatory_value)
+            self.log_on_data_dumper(["GUI INTERACTION", "REGULATORY SLIDER"], curr_regulatory_value)
             self.set_indicated_action(self.regulatory_slider)
 
             if self.regulatory_rods_pos == 0:
@@ -674,7 +683,7 @@ class NPPGui(QWidget):
         curr_safety_value = self.safety_slider.getValue()
 
         if curr_safety_value != self.safety_rods_pos:
-            self.control.log_on_data_dumper(["GUI INTERACTION", "SAFETY SLIDER"], curr_safety_value)
+            self.log_on_data_dumper(["GUI INTERACTION", "SAFETY SLIDER"], curr_safety_value)
             self.set_indicated_action(self.safety_slider)
 
             if self.safety_rods_pos == 0:
@@ -699,7 +708,7 @@ class NPPGui(QWidget):
         curr_sustain_value = self.sustain_slider.getValue()
 
         if curr_sustain_value != self.sustain_rods_pos:
-            self.control.log_on_data_dumper(["GUI INTERACTION", "SUSTAIN SLIDER"], curr_sustain_value)
+            self.log_on_data_dumper(["GUI INTERACTION", "SUSTAIN SLIDER"], curr_sustain_value)
             self.set_indicated_action(self.sustain_slider)
 
             if self.sustain_rods_pos == 0: